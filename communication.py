@@ -3,11 +3,42 @@ Utilities for client communication with the trusted server.
 You should not need to change this file.
 """
 
+import abc
+import asyncio
+import base64
+import collections
+import functools
 import json
+import logging
+import socket
+import struct
+import threading
 import time
-from typing import Union, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from secret_sharing import Share, ShareVector, share_from_value
+from serialization import BINARY_CONTENT_TYPE, decode_shares, pack_messages, unpack_messages
+
+
+logger = logging.getLogger(__name__)
+
+# the push transport listens next to the HTTP server, on its port plus this offset
+PUSH_PORT_OFFSET = 1
+
+# header of the requests telling the protocol run they belong to, the server keeping the
+# messages and triplets of each run apart
+SESSION_HEADER = "X-Session-Id"
+DEFAULT_SESSION = "default"
+
+# sender of the values opened by the server, see `Communication.contribute_opening`
+AGGREGATOR_ID = ""
+
+# label of the public message holding the address on which a party listens for its peers
+PEER_ADDRESS_LABEL = "peer_address"
 
 
 def sanitize_url_param(url_param: Union[bytes, str]) -> str:
@@ -34,6 +65,13 @@ class Communication:
         client_id: Identifier of this client
         poll_delay: delay between requests in seconds (default: 0.2 s)
         protocol: network protocol to use (default: "http")
+        long_poll_timeout: time in seconds the server waits for a message to be available before
+            answering a retrieval (default: 5 s), None to poll every `poll_delay` instead
+        pool_size: number of keep-alive connections kept open to the server (default: 10)
+        binary: exchange batches of messages and triplets with the server in the binary format of
+            `serialization` rather than in JSON (default: True)
+        session_id: identifier of the protocol run, the messages of other runs not being seen
+            (default: DEFAULT_SESSION)
     """
 
     def __init__(
@@ -42,16 +80,44 @@ class Communication:
             server_port: int,
             client_id: str,
             poll_delay: float = 0.2,
-            protocol: str = "http"
+            protocol: str = "http",
+            long_poll_timeout: Optional[float] = 5.0,
+            pool_size: int = 10,
+            binary: bool = True,
+            session_id: str = DEFAULT_SESSION
     ):
         self.base_url = f"{protocol}://{server_host}:{server_port}"
         self.client_id = client_id
         self.poll_delay = poll_delay
+        self.long_poll_timeout = long_poll_timeout
+        self.binary = binary
+        self.session_id = session_id
 
-        # Record metrics
+        # Every request reuses the connections of the pool instead of opening a new one
+        self.session = requests.Session()
+        self.session.mount(f"{protocol}://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+        self.session.headers[SESSION_HEADER] = session_id
+
+        if binary:
+            # the server answers in the binary format when asked to
+            self.session.headers["Accept"] = BINARY_CONTENT_TYPE
+
+        # Record metrics, updated from the threads of AsyncCommunication
+        self.metrics_lock = threading.Lock()
         self.bytes_received = 0
         self.bytes_sent = 0
         self.network_delays = 0
+        self.requests = 0
+        # retrievals answered before their message was available
+        self.unanswered_polls = 0
+        self.session.hooks["response"].append(self._count_request)
+
+    def close(self) -> None:
+        """
+        Close the connections to the server.
+        """
+        self.session.close()
 
     def send_private_message(
             self,
@@ -69,11 +135,12 @@ class Communication:
 
         start = time.time() * 1000
         url = f"{self.base_url}/private/{client_id_san}/{receiver_id_san}/{label_san}"
-        print(f"POST {url}")
-        requests.post(url, message)
+        logger.debug("POST %s", url)
+        self.session.post(url, message)
         stop = time.time() * 1000
-        self.network_delays += stop - start
-        self.bytes_sent += len(message)
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(message)
 
     def retrieve_private_message(
             self,
@@ -88,18 +155,19 @@ class Communication:
 
         url = f"{self.base_url}/private/{client_id_san}/{label_san}"
         # We can either use a websocket, or do some polling, but websockets would require asyncio.
-        # So we are doing polling to avoid introducing a new programming paradigm.
+        # So we are doing (long) polling to avoid introducing a new programming paradigm.
         start = time.time() * 1000
         while True:
-            print(f"GET  {url}")
-            res = requests.get(url)
+            logger.debug("GET  %s", url)
+            res = self.session.get(url, params=self._poll_params())
             if res.status_code == 200:
                 stop = time.time() * 1000
-                self.network_delays += stop - start
-                self.bytes_received += len(res.content)
+                with self.metrics_lock:
+                    self.network_delays += stop - start
+                    self.bytes_received += len(res.content)
 
                 return res.content
-            time.sleep(self.poll_delay)
+            self._wait_before_poll()
 
     def publish_message(
             self,
@@ -114,15 +182,16 @@ class Communication:
         label_san = sanitize_url_param(label)
 
         url = f"{self.base_url}/public/{client_id_san}/{label_san}"
-        print(f"POST {url}")
+        logger.debug("POST %s", url)
 
         start = time.time() * 1000
 
-        requests.post(url, message)
+        self.session.post(url, message)
 
         stop = time.time() * 1000
-        self.network_delays += stop - start
-        self.bytes_sent += len(message)
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(message)
 
     def retrieve_public_message(
             self,
@@ -140,42 +209,890 @@ class Communication:
         url = f"{self.base_url}/public/{client_id_san}/{sender_id_san}/{label_san}"
 
         # We can either use a websocket, or do some polling, but websockets would require asyncio.
-        # So we are doing polling to avoid introducing a new programming paradigm.
+        # So we are doing (long) polling to avoid introducing a new programming paradigm.
 
         start = time.time() * 1000
 
         while True:
-            print(f"GET  {url}")
-            res = requests.get(url)
+            logger.debug("GET  %s", url)
+            res = self.session.get(url, params=self._poll_params())
             if res.status_code == 200:
                 stop = time.time() * 1000
-                self.network_delays += stop - start
-                self.bytes_received += len(res.content)
+                with self.metrics_lock:
+                    self.network_delays += stop - start
+                    self.bytes_received += len(res.content)
 
                 return res.content
-            
+
+            self._wait_before_poll()
+
+    def publish_messages(
+            self,
+            messages: Dict[str, Union[bytes, str]]
+    ) -> None:
+        """
+        Publish many messages on the server in a single request.
+        In JSON, the messages must be text.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+
+        url = f"{self.base_url}/batch/public/{client_id_san}"
+
+        if self.binary:
+            body = pack_messages({
+                (sanitize_url_param(label),): message if isinstance(message, bytes) else message.encode()
+                for label, message in messages.items()
+            })
+            headers = {"Content-Type": BINARY_CONTENT_TYPE}
+        else:
+            body = json.dumps({
+                sanitize_url_param(label): message if isinstance(message, str) else message.decode()
+                for label, message in messages.items()
+            })
+            headers = None
+        logger.debug("POST %s", url)
+
+        start = time.time() * 1000
+
+        self.session.post(url, body, headers=headers)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(body)
+
+    def retrieve_public_messages(
+            self,
+            channels: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve many public messages, given as (sender_id, label) pairs, from the server.
+        Only return once every message is retrieved, asking each time for the missing ones only.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+        url = f"{self.base_url}/batch/public/{client_id_san}"
+
+        sanitized = {(sanitize_url_param(sender_id), sanitize_url_param(label)): (sender_id, label)
+                     for sender_id, label in channels}
+        messages = dict()
+
+        start = time.time() * 1000
+
+        while len(messages) < len(sanitized):
+            missing = [list(channel) for channel in sanitized if sanitized[channel] not in messages]
+            params = dict(self._poll_params() or {}, channels=json.dumps(missing))
+
+            logger.debug("GET  %s", url)
+            res = self.session.get(url, params=params)
+            with self.metrics_lock:
+                self.bytes_received += len(res.content)
+
+            res.raise_for_status()
+            if _is_binary(res):
+                for channel, message in unpack_messages(res.content, 2).items():
+                    messages[sanitized[channel]] = message
+            else:
+                # the messages are base64 encoded, as they may be binary even in the JSON format
+                for sender_id, label, message in json.loads(res.text):
+                    messages[sanitized[(sender_id, label)]] = base64.b64decode(message)
+
+            if len(messages) < len(sanitized):
+                self._wait_before_poll()
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+
+        return messages
+
+    def _count_request(self, res: requests.Response, *args, **kwargs) -> None:
+        """
+        Count the requests answered by the server.
+        """
+        with self.metrics_lock:
+            self.requests += 1
+
+    def _poll_params(self) -> Optional[dict]:
+        """
+        Query parameters asking the server to wait for the message, if long polling is enabled.
+        """
+        if self.long_poll_timeout is None:
+            return None
+        return {"timeout": self.long_poll_timeout}
+
+    def _wait_before_poll(self) -> None:
+        """
+        Wait before polling again, unless the server already waited for the message.
+        """
+        with self.metrics_lock:
+            self.unanswered_polls += 1
+        if self.long_poll_timeout is None:
             time.sleep(self.poll_delay)
 
     def retrieve_beaver_triplet_shares(
             self,
-            op_id: str
-    ) -> Tuple[int, int, int]:
+            op_id: str,
+            size: Optional[int] = None
+    ) -> Tuple[Union[Share, ShareVector], ...]:
         """
         Retrieve a triplet of shares generated by the trusted server.
+        If a size is given, each share is a ShareVector of `size` values.
+        Raise a requests.HTTPError if the server refuses them, e.g. if they were evicted before we
+        fetched them.
         """
 
         client_id_san = sanitize_url_param(self.client_id)
         op_id_san = sanitize_url_param(op_id)
 
         url = f"{self.base_url}/shares/{client_id_san}/{op_id_san}"
-        print(f"GET  {url}")
+        params = None if size is None else {"size": size}
+        logger.debug("GET  %s", url)
+
+        start = time.time() * 1000
+
+        res = self.session.get(url, params=params)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_received += len(res.content)
+
+        res.raise_for_status()
+        if _is_binary(res):
+            return tuple(decode_shares(res.content))
+
+        return tuple(share_from_value(value) for value in json.loads(res.text))
+
+    def retrieve_beaver_triplets_shares(
+            self,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> List[Tuple[Union[Share, ShareVector], ...]]:
+        """
+        Retrieve the triplets of shares of many operations in a single request.
+        `ops` lists the (operation id, size) pairs, see `retrieve_beaver_triplet_shares`.
+        Raise a requests.HTTPError if the server refuses them.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+
+        url = f"{self.base_url}/shares/{client_id_san}"
+        body = json.dumps([[sanitize_url_param(op_id), size] for op_id, size in ops])
+        logger.debug("POST %s", url)
+
+        start = time.time() * 1000
+
+        res = self.session.post(url, body)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(body)
+            self.bytes_received += len(res.content)
+
+        res.raise_for_status()
+        return _decode_triplets(res)
+
+    def contribute_opening(
+            self,
+            label: str,
+            message: Union[bytes, str]
+    ) -> None:
+        """
+        Send our shares of values to open to the server, which sums the shares of every participant.
+        Raise a requests.HTTPError if the server refuses them, e.g. if we already sent shares under
+        this label or not as many as the other participants.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+        label_san = sanitize_url_param(label)
+
+        url = f"{self.base_url}/open/{client_id_san}/{label_san}"
+        logger.debug("POST %s", url)
+
+        start = time.time() * 1000
+
+        res = self.session.post(url, message)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(message)
+
+        res.raise_for_status()
+
+    def retrieve_opening(
+            self,
+            label: str
+    ) -> bytes:
+        """
+        Retrieve the values opened by the server, once every participant sent its shares.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+        label_san = sanitize_url_param(label)
+
+        url = f"{self.base_url}/open/{client_id_san}/{label_san}"
+
+        start = time.time() * 1000
+        while True:
+            logger.debug("GET  %s", url)
+            res = self.session.get(url, params=self._poll_params())
+            if res.status_code == 200:
+                stop = time.time() * 1000
+                with self.metrics_lock:
+                    self.network_delays += stop - start
+                    self.bytes_received += len(res.content)
+
+                return res.content
+            self._wait_before_poll()
+
+    def retrieve_seed(self) -> Tuple[bytes, bool]:
+        """
+        Retrieve the seed from which the shares of the Beaver triplets and of the input masks are
+        derived, and whether we must retrieve the corrections of our c shares.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+
+        url = f"{self.base_url}/seeds/{client_id_san}"
+        logger.debug("GET  %s", url)
+
+        start = time.time() * 1000
+
+        res = self.session.get(url)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_received += len(res.content)
+
+        res.raise_for_status()
+        seed = res.json()
+        return bytes.fromhex(seed["seed"]), seed["designated"]
+
+    def retrieve_triplet_corrections(
+            self,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> List[Union[Share, ShareVector]]:
+        """
+        Retrieve the corrections of our c shares of the Beaver triplets derived from the seeds.
+        `ops` lists the (operation id, size) pairs, see `retrieve_beaver_triplet_shares`.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+
+        url = f"{self.base_url}/seeds/{client_id_san}/corrections"
+        body = json.dumps([[sanitize_url_param(op_id), size] for op_id, size in ops])
+        logger.debug("POST %s", url)
+
+        start = time.time() * 1000
+
+        res = self.session.post(url, body)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(body)
+            self.bytes_received += len(res.content)
+
+        res.raise_for_status()
+        if _is_binary(res):
+            return decode_shares(res.content)
+
+        return [share_from_value(value) for value in json.loads(res.text)]
+
+    def retrieve_input_masks(
+            self,
+            secrets: List[Tuple[str, Optional[int]]]
+    ) -> List[Union[Share, ShareVector]]:
+        """
+        Retrieve the masks of our secrets, given as (secret id, size) pairs, dealt by the server.
+        """
+
+        client_id_san = sanitize_url_param(self.client_id)
+
+        url = f"{self.base_url}/masks/{client_id_san}"
+        body = json.dumps([[secret_id, size] for secret_id, size in secrets])
+        logger.debug("POST %s", url)
+
+        start = time.time() * 1000
+
+        res = self.session.post(url, body)
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += len(body)
+            self.bytes_received += len(res.content)
+
+        res.raise_for_status()
+        if _is_binary(res):
+            return decode_shares(res.content)
+
+        return [share_from_value(value) for value in json.loads(res.text)]
+
+
+def _is_binary(res: requests.Response) -> bool:
+    """
+    Tell if the server answered in the binary format.
+    """
+    return res.headers.get("Content-Type") == BINARY_CONTENT_TYPE
+
+
+def _decode_triplets(res: requests.Response) -> List[Tuple[Union[Share, ShareVector], ...]]:
+    """
+    Decode the triplets of shares sent by the server, as a flat list of shares in the binary format,
+    or as a JSON list of triplets of values.
+    """
+    if _is_binary(res):
+        shares = decode_shares(res.content)
+        return [tuple(shares[i:i + 3]) for i in range(0, len(shares), 3)]
+
+    return [tuple(share_from_value(value) for value in triplet) for triplet in json.loads(res.text)]
+
+
+def send_frame(stream: BinaryIO, messages: Dict[Tuple[str, str, str], bytes]) -> int:
+    """
+    Write messages indexed by (pool, channel, label) on a push connection, as a single frame:
+    the length of the payload as a uint32, then the messages packed by `pack_messages`.
+    Return the number of bytes written.
+    """
+    payload = pack_messages(messages)
+    stream.write(struct.pack("<I", len(payload)) + payload)
+    return 4 + len(payload)
+
+
+def recv_frame(stream: BinaryIO) -> Optional[Dict[Tuple[str, str, str], bytes]]:
+    """
+    Read a frame written by `send_frame`, None once the connection is closed.
+    """
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+
+    length, = struct.unpack("<I", header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+
+    return unpack_messages(payload, 3)
+
+
+class MailboxCommunication(Communication, abc.ABC):
+    """
+    Network communications where the messages are pushed to us on persistent TCP connections as soon
+    as they are sent, instead of being polled from the server.
+
+    Messages travel in frames indexed by (pool, channel, label): ("private", receiver_id, label) for
+    private messages and ("public", sender_id, label) for public ones. Background threads store the
+    messages received in a mailbox, where the retrievals wait for them. The Beaver triplets are still
+    requested over HTTP. Subclasses choose where the frames sent go, see `_deliver`.
+    """
+
+    def __init__(
+            self,
+            server_host: str,
+            server_port: int,
+            client_id: str,
+            **kwargs
+    ):
+        super().__init__(server_host, server_port, client_id, **kwargs)
+
+        # (pool, channel, label) -> message, filled by the reader threads
+        self.mailbox: Dict[Tuple[str, str, str], bytes] = dict()
+        self.mailbox_condition = threading.Condition()
+        self.connected = True
+
+    def send_private_message(
+            self,
+            receiver_id: str,
+            label: str,
+            message: Union[bytes, str]
+    ) -> None:
+        """
+        Send a private message.
+        """
+        self._send({("private", sanitize_url_param(receiver_id), sanitize_url_param(label)): _as_bytes(message)})
+
+    def retrieve_private_message(
+            self,
+            label: str
+    ) -> bytes:
+        """
+        Retrieve a private message pushed to us.
+        """
+        key = ("private", sanitize_url_param(self.client_id), sanitize_url_param(label))
+        return self._wait_for([key])[key]
+
+    def publish_message(
+            self,
+            label: str,
+            message: Union[bytes, str]
+    ) -> None:
+        """
+        Publish a message.
+        """
+        self.publish_messages({label: message})
+
+    def retrieve_public_message(
+            self,
+            sender_id: str,
+            label: str
+    ) -> bytes:
+        """
+        Retrieve a public message pushed to us.
+        """
+        return self.retrieve_public_messages([(sender_id, label)])[(sender_id, label)]
+
+    def publish_messages(
+            self,
+            messages: Dict[str, Union[bytes, str]]
+    ) -> None:
+        """
+        Publish many messages in a single frame.
+        """
+        client_id_san = sanitize_url_param(self.client_id)
+        frame = {
+            ("public", client_id_san, sanitize_url_param(label)): _as_bytes(message)
+            for label, message in messages.items()
+        }
+
+        # our own messages are not pushed back to us
+        with self.mailbox_condition:
+            self.mailbox.update(frame)
+
+        self._send(frame)
+
+    def retrieve_public_messages(
+            self,
+            channels: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve many public messages, given as (sender_id, label) pairs, pushed to us.
+        """
+        keys = {channel: ("public", sanitize_url_param(channel[0]), sanitize_url_param(channel[1]))
+                for channel in channels}
+        messages = self._wait_for(keys.values())
+        return {channel: messages[key] for channel, key in keys.items()}
 
+    @abc.abstractmethod
+    def _deliver(self, frame: Dict[Tuple[str, str, str], bytes]) -> int:
+        """
+        Write a frame of messages on the connections it should go to.
+        Return the number of bytes of messages written.
+        """
+
+    def _send(self, frame: Dict[Tuple[str, str, str], bytes]) -> None:
+        """
+        Send a frame of messages.
+        """
         start = time.time() * 1000
 
-        res = requests.get(url)
+        bytes_sent = self._deliver(frame)
 
         stop = time.time() * 1000
-        self.network_delays += stop - start
-        self.bytes_received += len(res.content)
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_sent += bytes_sent
+
+    def _wait_for(self, keys: Iterable[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], bytes]:
+        """
+        Wait for messages to be pushed to us.
+        """
+        keys = list(keys)
+        start = time.time() * 1000
+
+        with self.mailbox_condition:
+            self.mailbox_condition.wait_for(
+                lambda: not self.connected or all(key in self.mailbox for key in keys))
+            if not all(key in self.mailbox for key in keys):
+                raise ConnectionError("connection closed")
+            messages = {key: self.mailbox[key] for key in keys}
+
+        stop = time.time() * 1000
+        with self.metrics_lock:
+            self.network_delays += stop - start
+            self.bytes_received += sum(len(message) for message in messages.values())
+
+        return messages
 
-        return tuple(json.loads(res.text))
+    def _read_frames(self, rfile: BinaryIO, sender_id: Optional[str] = None) -> None:
+        """
+        Store the messages read on a connection in the mailbox, until the connection is closed.
+        If the connection comes from a given sender, its public messages are stored as sent by it
+        and its private messages as sent to us, whatever their channel.
+        """
+        client_id_san = sanitize_url_param(self.client_id)
+
+        try:
+            while True:
+                frame = recv_frame(rfile)
+                if frame is None:
+                    return
+
+                if sender_id is not None:
+                    frame = {(pool, sender_id if pool == "public" else client_id_san, label): message
+                             for (pool, _, label), message in frame.items()}
+
+                with self.mailbox_condition:
+                    self.mailbox.update(frame)
+                    self.mailbox_condition.notify_all()
+        except (OSError, ValueError):
+            pass
+
+
+class PushCommunication(MailboxCommunication):
+    """
+    Network communications with the server, the messages being sent on a persistent TCP connection
+    to the server, which pushes them to their receivers.
+
+    Attributes:
+        push_port: port of the push transport of the server (default: server_port + PUSH_PORT_OFFSET)
+        Other attributes are the ones of Communication.
+    """
+
+    def __init__(
+            self,
+            server_host: str,
+            server_port: int,
+            client_id: str,
+            push_port: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(server_host, server_port, client_id, **kwargs)
+
+        if push_port is None:
+            push_port = server_port + PUSH_PORT_OFFSET
+
+        self.socket = socket.create_connection((server_host, push_port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.socket.makefile("rb")
+        self.wfile = self.socket.makefile("wb")
+        self.send_lock = threading.Lock()
+
+        # the first frame tells the server who we are, and our protocol run
+        self._send({("hello", sanitize_url_param(client_id), self.session_id): b""})
+
+        self.reader = threading.Thread(target=self._read_server_frames, daemon=True)
+        self.reader.start()
+
+    def retrieve_opening(
+            self,
+            label: str
+    ) -> bytes:
+        """
+        Retrieve the values opened by the server, pushed once every participant sent its shares.
+        """
+        key = ("opened", AGGREGATOR_ID, sanitize_url_param(label))
+        return self._wait_for([key])[key]
+
+    def close(self) -> None:
+        """
+        Close the connections to the server.
+        """
+        _close_socket(self.socket)
+        super().close()
+
+    def _deliver(self, frame: Dict[Tuple[str, str, str], bytes]) -> int:
+        """
+        Write a frame of messages to the server.
+        """
+        with self.send_lock:
+            send_frame(self.wfile, frame)
+            self.wfile.flush()
+
+        return sum(len(message) for message in frame.values())
+
+    def _read_server_frames(self) -> None:
+        """
+        Store the messages pushed by the server, and wake up the retrievals once disconnected.
+        """
+        self._read_frames(self.rfile)
+
+        with self.mailbox_condition:
+            self.connected = False
+            self.mailbox_condition.notify_all()
+
+
+class PeerCommunication(MailboxCommunication):
+    """
+    Network communications sending the messages directly to the other parties on TCP connections,
+    the server being only used to find the other parties and to deal the Beaver triplets.
+
+    Every party listens on a port of its own, and publishes its address on the server under the
+    PEER_ADDRESS_LABEL label. The connection to a peer is opened the first time a message is sent to
+    it, and stays open. Public messages are sent to every peer. The address is deleted from the
+    server once every other party read it, so it stays there if no peer ever sends us a message.
+
+    A peer is known by the id it declares in the first frame of its connection. This id is not
+    authenticated: like with the server, the parties trust the network not to impersonate them.
+
+    Attributes:
+        peer_ids: identifiers of the parties to which the public messages are sent
+        peer_host: host on which to listen for the other parties (default: "localhost")
+        Other attributes are the ones of Communication.
+    """
+
+    def __init__(
+            self,
+            server_host: str,
+            server_port: int,
+            client_id: str,
+            peer_ids: List[str],
+            peer_host: str = "localhost",
+            **kwargs
+    ):
+        super().__init__(server_host, server_port, client_id, **kwargs)
+
+        self.peer_ids = [sanitize_url_param(pid) for pid in peer_ids if pid != client_id]
+
+        # peer id -> stream on which we write to it
+        self.connections: Dict[str, BinaryIO] = dict()
+        self.sockets: List[socket.socket] = []
+        self.connections_lock = threading.Lock()
+
+        self.listener = socket.create_server((peer_host, 0))
+        threading.Thread(target=self._accept_peers, daemon=True).start()
+
+        # rendezvous: the others find our address on the server
+        Communication.publish_message(self, PEER_ADDRESS_LABEL, json.dumps(self.listener.getsockname()[:2]))
+
+    def close(self) -> None:
+        """
+        Close the connections to the other parties, and stop listening for new ones.
+        """
+        with self.connections_lock:
+            for sock in self.sockets + [self.listener]:
+                _close_socket(sock)
+        super().close()
+
+    def _deliver(self, frame: Dict[Tuple[str, str, str], bytes]) -> int:
+        """
+        Write a frame of messages to the parties who should receive them: the receiver of a private
+        message, every peer for a public one.
+        """
+        frames = collections.defaultdict(dict)
+        for (pool, channel, label), message in frame.items():
+            for peer_id in (self.peer_ids if pool == "public" else [channel]):
+                frames[peer_id][(pool, channel, label)] = message
+
+        bytes_sent = 0
+
+        with self.connections_lock:
+            self._connect([peer_id for peer_id in frames if peer_id not in self.connections])
+
+            for peer_id, peer_frame in frames.items():
+                send_frame(self.connections[peer_id], peer_frame)
+                self.connections[peer_id].flush()
+                bytes_sent += sum(len(message) for message in peer_frame.values())
+
+        return bytes_sent
+
+    def _connect(self, peer_ids: List[str]) -> None:
+        """
+        Open the connections to peers, looking for their addresses on the server.
+        """
+        if not peer_ids:
+            return
+
+        addresses = Communication.retrieve_public_messages(
+            self, [(peer_id, PEER_ADDRESS_LABEL) for peer_id in peer_ids])
+
+        for peer_id in peer_ids:
+            host, port = json.loads(addresses[(peer_id, PEER_ADDRESS_LABEL)])
+
+            sock = socket.create_connection((host, port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sockets.append(sock)
+            self.connections[peer_id] = sock.makefile("wb")
+
+            # the first frame tells the peer who we are
+            send_frame(self.connections[peer_id], {("hello", sanitize_url_param(self.client_id), ""): b""})
+
+    def _accept_peers(self) -> None:
+        """
+        Accept the connections of the other parties, reading each of them in its own thread.
+        """
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.connections_lock:
+                self.sockets.append(sock)
+            threading.Thread(target=self._read_peer_frames, args=(sock,), daemon=True).start()
+
+    def _read_peer_frames(self, sock: socket.socket) -> None:
+        """
+        Store the messages sent by a peer, once it told us who it is.
+        Connections of parties that are not our peers are dropped.
+        """
+        rfile = sock.makefile("rb")
+
+        hello = recv_frame(rfile)
+        if not hello:
+            return
+        (_, sender_id, _), = hello.keys()
+        if sender_id not in self.peer_ids:
+            logger.warning("dropping the connection of unknown peer %s", sender_id)
+            _close_socket(sock)
+            return
+
+        self._read_frames(rfile, sender_id)
+
+
+def _close_socket(sock: socket.socket) -> None:
+    """
+    Shut a socket down and close it.
+    """
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+def _as_bytes(message: Union[bytes, str]) -> bytes:
+    """
+    Encode a text message, leave a binary one as is.
+    """
+    return message if isinstance(message, bytes) else message.encode()
+
+
+class AsyncCommunication:
+    """
+    Asyncio interface to the network communications with the server.
+
+    The requests of the wrapped Communication are blocking, so they run in a pool of threads:
+    awaiting many retrievals at once waits for them concurrently, e.g. one per peer.
+    While requests run concurrently, the network delays of the Communication record the time
+    spent waiting for all of them, not the sum of their durations.
+
+    Attributes:
+        comm: Communication doing the requests
+        max_workers: maximum number of concurrent requests (default: chosen by ThreadPoolExecutor)
+    """
+
+    def __init__(
+            self,
+            comm: Communication,
+            max_workers: Optional[int] = None
+    ):
+        self.comm = comm
+        self.executor = ThreadPoolExecutor(max_workers)
+
+    def close(self) -> None:
+        """
+        Stop the pool of threads and close the communications. The pending requests are cancelled,
+        so that a failed computation does not wait for retrievals that will never be answered.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.comm.close()
+
+    async def send_private_message(self, receiver_id: str, label: str, message: Union[bytes, str]) -> None:
+        """
+        Send a private message to the server.
+        """
+        await self._run(self.comm.send_private_message, receiver_id, label, message)
+
+    async def retrieve_private_message(self, label: str) -> bytes:
+        """
+        Retrieve a private message from the server.
+        """
+        return await self._run(self.comm.retrieve_private_message, label)
+
+    async def publish_message(self, label: str, message: Union[bytes, str]) -> None:
+        """
+        Publish a message on the server.
+        """
+        await self._run(self.comm.publish_message, label, message)
+
+    async def retrieve_public_message(self, sender_id: str, label: str) -> bytes:
+        """
+        Retrieve a public message from the server.
+        """
+        return await self._run(self.comm.retrieve_public_message, sender_id, label)
+
+    async def publish_messages(self, messages: Dict[str, Union[bytes, str]]) -> None:
+        """
+        Publish many messages on the server in a single request.
+        """
+        await self._run(self.comm.publish_messages, messages)
+
+    async def retrieve_public_messages(self, channels: List[Tuple[str, str]]) -> Dict[Tuple[str, str], bytes]:
+        """
+        Retrieve many public messages, given as (sender_id, label) pairs, from the server.
+        """
+        return await self._run(self.comm.retrieve_public_messages, channels)
+
+    async def retrieve_beaver_triplets_shares(
+            self,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> List[Tuple[Union[Share, ShareVector], ...]]:
+        """
+        Retrieve the triplets of shares of many operations in a single request.
+        """
+        return await self._run(self.comm.retrieve_beaver_triplets_shares, ops)
+
+    async def contribute_opening(self, label: str, message: Union[bytes, str]) -> None:
+        """
+        Send our shares of values to open to the server.
+        """
+        await self._run(self.comm.contribute_opening, label, message)
+
+    async def retrieve_opening(self, label: str) -> bytes:
+        """
+        Retrieve the values opened by the server.
+        """
+        return await self._run(self.comm.retrieve_opening, label)
+
+    async def retrieve_seed(self) -> Tuple[bytes, bool]:
+        """
+        Retrieve the seed from which the shares of the Beaver triplets and of the input masks are derived.
+        """
+        return await self._run(self.comm.retrieve_seed)
+
+    async def retrieve_triplet_corrections(
+            self,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> List[Union[Share, ShareVector]]:
+        """
+        Retrieve the corrections of our c shares of the Beaver triplets derived from the seeds.
+        """
+        return await self._run(self.comm.retrieve_triplet_corrections, ops)
+
+    async def retrieve_input_masks(
+            self,
+            secrets: List[Tuple[str, Optional[int]]]
+    ) -> List[Union[Share, ShareVector]]:
+        """
+        Retrieve the masks of our secrets dealt by the server.
+        """
+        return await self._run(self.comm.retrieve_input_masks, secrets)
+
+    async def gather(self, *coroutines) -> list:
+        """
+        Run coroutines of this object concurrently and return their results in order.
+        """
+        with self.comm.metrics_lock:
+            network_delays = self.comm.network_delays
+        start = time.time() * 1000
+
+        results = await asyncio.gather(*coroutines)
+
+        stop = time.time() * 1000
+        with self.comm.metrics_lock:
+            self.comm.network_delays = network_delays + stop - start
+
+        return list(results)
+
+    async def _run(self, method, *args):
+        """
+        Run a blocking method of the Communication in the pool of threads.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args))
@@ -6,14 +6,20 @@ Example expression:
 >>> bob_secret = Secret()
 >>> expr = alice_secret * bob_secret * Scalar(2)
 
+Secrets and Scalars can also hold a list of values, in which case the expression is computed
+element-wise over the whole batch, a single value being applied to every element.
+
 MODIFY THIS FILE.
 """
 
 import base64
 import random
-from typing import Optional
+from typing import List, Optional, Tuple, Union
+
+from secret_sharing import share_from_value, share_value
 
-ID_BYTES = 4
+# large enough for the ids of circuits with millions of operations not to collide
+ID_BYTES = 8
 
 
 def gen_id() -> bytes:
@@ -23,39 +29,56 @@ def gen_id() -> bytes:
     return base64.b64encode(id_bytes)
 
 
-def operation_formatting(op, depth: int = 0) -> str:
+def operation_formatting(op) -> str:
+    """Format an operation with the minimal parentheses, without recursion"""
 
-    res = ""
+    parts = []
 
-    if not isinstance(op, (Scalar, Secret)):
+    # either a node to format or a literal string to output
+    stack = [")", op, "("]
+    while stack:
+        item = stack.pop()
 
-        if isinstance(op, Multiplication):
-            if isinstance(op.e1, (Scalar, Secret, Multiplication)) and isinstance(op.e2, (Scalar, Secret, Multiplication)):
-                res = f"{operation_formatting(op.e1, depth+1)}{op.op}{operation_formatting(op.e2, depth+1)}"
+        if isinstance(item, str):
+            parts.append(item)
 
-            elif isinstance(op.e1, (Scalar, Secret)) and not isinstance(op.e2, (Scalar, Secret, Multiplication)):
-                res = f"{operation_formatting(op.e1, depth + 1)}{op.op}({operation_formatting(op.e2, depth + 1)})"
+        elif isinstance(item, (Scalar, Secret)):
+            parts.append(repr(item))
 
-            elif not isinstance(op.e1, (Scalar, Secret, Multiplication)) and isinstance(op.e2, (Scalar, Secret)):
-                res = f"({operation_formatting(op.e1, depth + 1)}){op.op}{operation_formatting(op.e2, depth + 1)}"
+        else:
+            parenthesize_e1, parenthesize_e2 = _operand_parentheses(item)
 
-            else:
-                res = f"({operation_formatting(op.e1, depth + 1)}){op.op}({operation_formatting(op.e2, depth + 1)})"
+            stack.extend(")" if parenthesize_e2 else "")
+            stack.append(item.e2)
+            stack.extend("(" if parenthesize_e2 else "")
+            stack.append(item.op)
+            stack.extend(")" if parenthesize_e1 else "")
+            stack.append(item.e1)
+            stack.extend("(" if parenthesize_e1 else "")
 
-        elif isinstance(op, Substraction):
-            if not isinstance(op.e2, (Scalar, Secret)):
-                res = f"{operation_formatting(op.e1, depth + 1)}{op.op}({operation_formatting(op.e2, depth + 1)})"
+    return "".join(parts)
 
-            else:
-                res = f"{operation_formatting(op.e1, depth + 1)}{op.op}{operation_formatting(op.e2, depth + 1)}"
+
+def _operand_parentheses(op) -> Tuple[bool, bool]:
+    """Tell which operands of an operation must be put in parentheses"""
+
+    if isinstance(op, Multiplication):
+        if isinstance(op.e1, (Scalar, Secret, Multiplication)) and isinstance(op.e2, (Scalar, Secret, Multiplication)):
+            return False, False
+
+        elif isinstance(op.e1, (Scalar, Secret)) and not isinstance(op.e2, (Scalar, Secret, Multiplication)):
+            return False, True
+
+        elif not isinstance(op.e1, (Scalar, Secret, Multiplication)) and isinstance(op.e2, (Scalar, Secret)):
+            return True, False
 
         else:
-            res = f"{operation_formatting(op.e1, depth + 1)}{op.op}{operation_formatting(op.e2, depth + 1)}"
+            return True, True
 
-    else:
-        res = f"{repr(op)}"
+    elif isinstance(op, Substraction):
+        return False, not isinstance(op.e2, (Scalar, Secret))
 
-    return res if depth != 0 else f"({res})"
+    return False, False
 
 
 class Expression:
@@ -89,14 +112,15 @@ class Expression:
 
 
 class Scalar(Expression):
-    """Term representing a scalar finite field value."""
+    """Term representing a scalar finite field value, or a vector of values."""
 
     def __init__(
             self,
-            value: int,
+            value: Union[int, List[int]],
             id: Optional[bytes] = None
     ):
         self.value = value
+        self.is_public = True
         super().__init__(id)
 
     def __repr__(self):
@@ -109,14 +133,15 @@ class Scalar(Expression):
 
 
 class Secret(Expression):
-    """Term representing a secret finite field value (variable)."""
+    """Term representing a secret finite field value (variable), or a vector of values."""
 
     def __init__(
             self,
-            value: Optional[int] = None,
+            value: Optional[Union[int, List[int]]] = None,
             id: Optional[bytes] = None
     ):
         self.value = value
+        self.is_public = False
         super().__init__(id)
 
     def __repr__(self):
@@ -138,6 +163,8 @@ class Addition(Expression):
         self.e1 = e1
         self.e2 = e2
         self.op = " + "
+        # an operation is public iff it does not depend on any secret, computed once at construction
+        self.is_public = e1.is_public and e2.is_public
         super().__init__(id)
 
     def __repr__(self):
@@ -157,6 +184,8 @@ class Substraction(Expression):
         self.e1 = e1
         self.e2 = e2
         self.op = " - "
+        # an operation is public iff it does not depend on any secret, computed once at construction
+        self.is_public = e1.is_public and e2.is_public
         super().__init__(id)
 
     def __repr__(self):
@@ -176,9 +205,214 @@ class Multiplication(Expression):
         self.e1 = e1
         self.e2 = e2
         self.op = " * "
+        # an operation is public iff it does not depend on any secret, computed once at construction
+        self.is_public = e1.is_public and e2.is_public
         super().__init__(id)
 
     def __repr__(self):
         return (
             f"{operation_formatting(self)}"
         )
+
+
+def multiplication_layers(expr: Expression) -> List[List[Multiplication]]:
+    """
+    Group the secret-by-secret multiplications of an expression by multiplicative depth.
+
+    The multiplications of a layer only depend on multiplications of the previous layers, so all of
+    them can be opened in a single communication round. Layers are returned in evaluation order and
+    the order inside a layer is deterministic, so every party schedules the rounds identically.
+    """
+
+    layers = []
+    depths = dict()  # id(node) -> multiplicative depth, None for sub-expressions without secrets
+
+    stack = [(expr, False)]
+    while stack:
+        node, children_done = stack.pop()
+
+        if id(node) in depths:
+            continue
+
+        if node.is_public:
+            depths[id(node)] = None
+
+        elif isinstance(node, Secret):
+            depths[id(node)] = 0
+
+        elif not children_done:
+            stack.append((node, True))
+            stack.append((node.e2, False))
+            stack.append((node.e1, False))
+
+        else:
+            d1 = depths[id(node.e1)]
+            d2 = depths[id(node.e2)]
+
+            if d1 is None:
+                depth = d2
+            elif d2 is None:
+                depth = d1
+            elif isinstance(node, Multiplication):
+                # both operands are secret: this multiplication needs a Beaver round
+                depth = max(d1, d2) + 1
+                if depth > len(layers):
+                    layers.append([])
+                layers[depth - 1].append(node)
+            else:
+                depth = max(d1, d2)
+
+            depths[id(node)] = depth
+
+    return layers
+
+
+def balance(expr: Expression) -> Expression:
+    """
+    Rebuild the chains of Additions and Multiplications of an expression as balanced trees.
+
+    Expressions built incrementally (e.g. `circuit *= secret`) are left-deep, which makes the
+    multiplicative depth of a product of N factors equal to N. Both operations are associative,
+    so every chain is flattened and its operands are combined pairwise, giving a depth of log N.
+
+    The internal nodes of a rebuilt chain reuse the ids of the original chain in a deterministic
+    order, so every party balancing the same expression gets the same operation ids. Leaves are
+    kept as is. Sub-expressions referenced more than once are not merged into the chains of
+    their parents, so that an operation id never ends up on two different nodes.
+    """
+
+    # count the references to every node to detect shared sub-expressions
+    refs = dict()
+    stack = [expr]
+    while stack:
+        node = stack.pop()
+        refs[id(node)] = refs.get(id(node), 0) + 1
+
+        if refs[id(node)] == 1 and isinstance(node, (Addition, Substraction, Multiplication)):
+            stack.append(node.e2)
+            stack.append(node.e1)
+
+    rebuilt = dict()  # id(original node) -> balanced node
+    chains = dict()  # id(chain root) -> (operands, ids of the internal nodes)
+
+    stack = [(expr, False)]
+    while stack:
+        node, children_done = stack.pop()
+
+        if id(node) in rebuilt:
+            continue
+
+        if isinstance(node, (Scalar, Secret)):
+            rebuilt[id(node)] = node
+
+        elif isinstance(node, Substraction):
+            if children_done:
+                rebuilt[id(node)] = Substraction(rebuilt[id(node.e1)], rebuilt[id(node.e2)], id=node.id)
+            else:
+                stack.append((node, True))
+                stack.append((node.e2, False))
+                stack.append((node.e1, False))
+
+        elif children_done:
+            operands, ids = chains.pop(id(node))
+            rebuilt[id(node)] = _balanced_chain(type(node), [rebuilt[id(op)] for op in operands], ids)
+
+        else:
+            chains[id(node)] = _flatten_chain(node, refs)
+            stack.append((node, True))
+            stack.extend((op, False) for op in reversed(chains[id(node)][0]))
+
+    return rebuilt[id(expr)]
+
+
+def _flatten_chain(root: Expression, refs: dict) -> Tuple[List[Expression], List[bytes]]:
+    """Return the operands, from left to right, and the ids of the internal nodes of a chain"""
+
+    operands = []
+    ids = []
+
+    stack = [root]
+    while stack:
+        node = stack.pop()
+
+        if node is root or (type(node) is type(root) and refs[id(node)] == 1):
+            ids.append(node.id)
+            stack.append(node.e2)
+            stack.append(node.e1)
+        else:
+            operands.append(node)
+
+    return operands, ids
+
+
+def _balanced_chain(op_type: type, operands: List[Expression], ids: List[bytes]) -> Expression:
+    """Combine the operands of a chain pairwise, level by level, reusing the given ids in order"""
+
+    ids = iter(ids)
+
+    while len(operands) > 1:
+        level = [op_type(operands[i], operands[i + 1], id=next(ids)) for i in range(0, len(operands) - 1, 2)]
+
+        if len(operands) % 2 == 1:
+            level.append(operands[-1])
+
+        operands = level
+
+    return operands[0]
+
+
+def fold_constants(expr: Expression) -> Expression:
+    """
+    Collapse every sub-expression that only contains Scalars into a single Scalar.
+
+    Values are computed modulo 2^64, element-wise for vectors, and a folded Scalar keeps the id of the sub-expression it
+    replaces. When the whole expression is public, the result is a single Scalar.
+    """
+
+    folded = dict()  # id(node) -> Share or ShareVector for public nodes, folded expression otherwise
+
+    stack = [(expr, False)]
+    while stack:
+        node, children_done = stack.pop()
+
+        if id(node) in folded:
+            continue
+
+        if isinstance(node, (Scalar, Secret)):
+            folded[id(node)] = share_from_value(node.value) if node.is_public else node
+
+        elif not children_done:
+            stack.append((node, True))
+            stack.append((node.e2, False))
+            stack.append((node.e1, False))
+
+        elif node.is_public:
+            if isinstance(node, Addition):
+                folded[id(node)] = folded[id(node.e1)] + folded[id(node.e2)]
+            elif isinstance(node, Substraction):
+                folded[id(node)] = folded[id(node.e1)] - folded[id(node.e2)]
+            else:
+                folded[id(node)] = folded[id(node.e1)] * folded[id(node.e2)]
+
+        else:
+            e1 = _folded_expression(node.e1, folded)
+            e2 = _folded_expression(node.e2, folded)
+
+            if e1 is node.e1 and e2 is node.e2:
+                folded[id(node)] = node
+            else:
+                folded[id(node)] = type(node)(e1, e2, id=node.id)
+
+    return _folded_expression(expr, folded)
+
+
+def _folded_expression(node: Expression, folded: dict) -> Expression:
+    """Return the folded version of a node, wrapping public values in Scalars"""
+
+    if isinstance(node, Scalar):
+        return node
+
+    if node.is_public:
+        return Scalar(share_value(folded[id(node)]), id=node.id)
+
+    return folded[id(node)]
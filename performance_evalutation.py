@@ -2,10 +2,12 @@ import random
 import time
 from multiprocessing import Process, Queue
 
+from communication import Communication
 from expression import Scalar, Secret
 from protocol import ProtocolSpec
-from secret_sharing import get_mod
+from secret_sharing import get_mod, mul_mod, share_secret
 from server import run
+from ttp import gen_triplets_shares
 
 from smc_party import SMCParty
 import os
@@ -204,6 +206,104 @@ def mul_secret():
             suite(parties, circuit, total)
 
 
+def throughput_client(client_id, participants, threaded, queue):
+    comm = Communication(
+        "localhost",
+        5000,
+        client_id,
+        poll_delay=0.01,
+        long_poll_timeout=5.0 if threaded else None
+    )
+    start = time.time()
+
+    comm.publish_message("throughput", client_id)
+    for pid in participants:
+        # our own message is deleted once every other party read it
+        if pid != client_id:
+            comm.retrieve_public_message(pid, "throughput")
+    comm.retrieve_beaver_triplet_shares("throughput")
+
+    queue.put((comm.requests, start, time.time()))
+
+
+def measure_throughput(num_part, threaded):
+    """
+    Every party publishes a message, retrieves the message of every other party one by one, and fetches
+    a Beaver triplet. Return the number of requests served and the time they took, in seconds.
+    """
+    participants = [str(p) for p in range(num_part)]
+    queue = Queue()
+
+    server = Process(target=run, args=("localhost", 5000, participants, None, threaded))
+    clients = [Process(target=throughput_client, args=(pid, participants, threaded, queue)) for pid in participants]
+
+    server.start()
+    time.sleep(3)
+    for client in clients:
+        client.start()
+
+    results = [queue.get() for _ in clients]
+    for client in clients:
+        client.join()
+
+    server.terminate()
+    server.join()
+    time.sleep(2)
+
+    requests = sum(nbr for nbr, _, _ in results)
+    elapsed = max(stop for _, _, stop in results) - min(start for _, start, _ in results)
+    return requests, elapsed
+
+
+def server_throughput():
+    """
+    Requests per second served by the server, one at a time or concurrently, with 10, 50 and 100 parties.
+    """
+    for _ in range(repeat_experiment):
+        for threaded in (False, True):
+            for num_part in [10, 50, 100]:
+                requests, elapsed = measure_throughput(num_part, threaded)
+
+                res_file = open("metrics/server_throughput/throughput.txt", "a")
+                res_file.write(str(threaded) + "," + str(num_part) + "," + str(requests) + "," + str(elapsed) + "," + str(
+                    requests / elapsed) + "\n")
+                res_file.close()
+
+
+def gen_triplets_one_by_one(num_participants, count):
+    """
+    Generate `count` Beaver triplets the way the trusted party did before the batches: one at a time,
+    every value drawn with random.randint and shared with share_secret.
+    """
+    for _ in range(count):
+        a = random.randint(0, get_mod())
+        b = random.randint(0, get_mod())
+
+        for value in (a, b, mul_mod(a, b)):
+            share_secret(value, num_participants)
+
+
+def triplet_generation_throughput(num_participants=100, num_triplets=10 ** 5, batch_size=10 ** 4):
+    """
+    Beaver triplets per second generated one by one and in batches, for 100 parties.
+    The batches are generated in chunks of `batch_size` triplets to bound the memory used.
+    """
+    for _ in range(repeat_experiment):
+        start = time.perf_counter()
+        gen_triplets_one_by_one(num_participants, num_triplets)
+        single_rate = num_triplets / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(num_triplets // batch_size):
+            gen_triplets_shares(num_participants, batch_size)
+        batch_rate = num_triplets / (time.perf_counter() - start)
+
+        res_file = open("metrics/triplet_generation/throughput.txt", "a")
+        res_file.write(str(num_participants) + "," + str(num_triplets) + "," + str(single_rate) + "," + str(
+            batch_rate) + "\n")
+        res_file.close()
+
+
 if not os.path.exists("metrics"):
     os.mkdir("metrics")
 
@@ -222,8 +322,16 @@ if not os.path.exists("metrics/mul_scalar"):
 if not os.path.exists("metrics/mul_secret"):
     os.mkdir("metrics/mul_secret")
 
+if not os.path.exists("metrics/server_throughput"):
+    os.mkdir("metrics/server_throughput")
+
+if not os.path.exists("metrics/triplet_generation"):
+    os.mkdir("metrics/triplet_generation")
+
 # fixed_circuit_more_participants()
 # add_scalar()
 # add_secret()
 # mul_scalar()
 mul_secret()
+# server_throughput()
+# triplet_generation_throughput()
@@ -1,3 +1,6 @@
+import uuid
+from typing import Optional
+
 from expression import Expression
 
 
@@ -7,8 +10,11 @@ class ProtocolSpec:
     Attributes:
         participant_ids: List of IDs of the participating clients
         expr: Expression to be computed
+        session_id: Identifier of this run of the protocol, keeping its messages apart from the
+            ones of other runs on the same server (default: a random identifier)
     """
 
-    def __init__(self, participant_ids: list, expr: Expression):
+    def __init__(self, participant_ids: list, expr: Expression, session_id: Optional[str] = None):
         self.participant_ids = participant_ids
         self.expr = expr
+        self.session_id = uuid.uuid4().hex if session_id is None else session_id
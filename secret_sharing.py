@@ -1,9 +1,16 @@
 """
 Secret sharing scheme.
 """
+import hashlib
+import os
 import random
 import sys
-from typing import List
+from typing import Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+# number of bytes of the seeds from which pseudo-random shares are derived
+SEED_BYTES = 16
 
 
 class Share:
@@ -21,18 +28,88 @@ class Share:
         return f"{self.__class__.__name__}({self.value})"
 
     def __add__(self, other):
+        if isinstance(other, ShareVector):
+            return NotImplemented
         val = add_mod(self.value, other.value)
         return Share(val)
 
     def __sub__(self, other):
+        if isinstance(other, ShareVector):
+            return NotImplemented
         val = sub_mod(self.value, other.value)
         return Share(val)
 
     def __mul__(self, other):
+        if isinstance(other, ShareVector):
+            return NotImplemented
         val = mul_mod(self.value, other.value)
         return Share(val)
 
 
+class ShareVector:
+    """
+    A vector of secret shares in the finite field, backed by a uint64 NumPy array.
+
+    The field is exactly the integers modulo 2^64, so the natural wraparound of uint64 arithmetic
+    does the reduction. Operations with a Share apply the same value to every element.
+    """
+
+    def __init__(
+            self,
+            values: Union[np.ndarray, Iterable[int]] = ()
+    ):
+        self.values = to_uint64(values)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.values.tolist()})"
+
+    def __len__(self):
+        return len(self.values)
+
+    def __add__(self, other):
+        return ShareVector(self.values + _operand_values(other))
+
+    def __radd__(self, other):
+        return ShareVector(_operand_values(other) + self.values)
+
+    def __sub__(self, other):
+        return ShareVector(self.values - _operand_values(other))
+
+    def __rsub__(self, other):
+        return ShareVector(_operand_values(other) - self.values)
+
+    def __mul__(self, other):
+        return ShareVector(self.values * _operand_values(other))
+
+    def __rmul__(self, other):
+        return ShareVector(_operand_values(other) * self.values)
+
+
+def _operand_values(share: Union[Share, ShareVector]) -> Union[np.ndarray, np.uint64]:
+    """Return the uint64 values of the other operand of a ShareVector operation"""
+
+    if isinstance(share, ShareVector):
+        return share.values
+
+    return np.uint64(share.value % max_nbr)
+
+
+def to_uint64(values: Union[np.ndarray, Iterable[int]]) -> np.ndarray:
+    """Convert integers to an array of field elements, reducing them modulo 2^64"""
+
+    if isinstance(values, np.ndarray) and values.dtype == np.uint64:
+        return values
+
+    return np.array([v % max_nbr for v in values], dtype=np.uint64)
+
+
+def random_uint64(shape) -> np.ndarray:
+    """Draw uniformly random field elements from the OS cryptographically secure generator"""
+
+    count = int(np.prod(shape))
+    return np.frombuffer(os.urandom(8 * count), dtype="<u8").astype(np.uint64).reshape(shape)
+
+
 def share_secret(secret: int, num_shares: int) -> List[Share]:
     """Generate secret shares."""
 
@@ -60,22 +137,135 @@ def reconstruct_secret(shares: List[Share]) -> int:
     return res
 
 
+def share_value(share: Union[Share, ShareVector]) -> Union[int, List[int]]:
+    """Return the value of a share as a JSON serializable int or list of ints"""
+
+    if isinstance(share, ShareVector):
+        return share.values.tolist()
+
+    return share.value
+
+
+def share_from_value(value: Union[int, List[int]]) -> Union[Share, ShareVector]:
+    """Build a Share from an int, or a ShareVector from a list of ints"""
+
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return ShareVector(value)
+
+    return Share(value)
+
+
+def vector_size(*shares: Union[Share, ShareVector]) -> Optional[int]:
+    """Return the size of the vectors among the shares, None if they are all single values"""
+
+    return max_size(*(len(share) if isinstance(share, ShareVector) else None for share in shares))
+
+
+def max_size(*sizes: Optional[int]) -> Optional[int]:
+    """Return the size of the result of an element-wise operation on operands of the given sizes"""
+
+    sizes = [size for size in sizes if size is not None]
+
+    return max(sizes) if sizes else None
+
+
+def share_secrets(secrets: Union[np.ndarray, Iterable[int]], num_shares: int) -> List[ShareVector]:
+    """Generate the secret shares of many secrets at once, one ShareVector per participant."""
+
+    secrets = to_uint64(secrets)
+
+    random_shares = random_uint64((num_shares - 1, len(secrets)))
+    last_shares = secrets - random_shares.sum(axis=0, dtype=np.uint64)
+
+    return [ShareVector(values) for values in random_shares] + [ShareVector(last_shares)]
+
+
+def reconstruct_secrets(shares: List[ShareVector]) -> np.ndarray:
+    """Reconstruct many secrets at once from the ShareVectors of every participant."""
+
+    return np.sum([share.values for share in shares], axis=0, dtype=np.uint64)
+
+
+def new_seed() -> bytes:
+    """Draw a seed for `prg_share` from the OS cryptographically secure generator"""
+
+    return os.urandom(SEED_BYTES)
+
+
+def prg_share(seed: bytes, label: str, size: Optional[int] = None) -> Union[Share, ShareVector]:
+    """
+    Derive a pseudo-random share from a seed, a ShareVector of `size` values or a single Share.
+    The same seed and label always give the same share, so that only the seed has to be sent.
+    """
+
+    count = 1 if size is None else size
+    digest = hashlib.shake_256(seed + label.encode()).digest(8 * count)
+    values = np.frombuffer(digest, dtype="<u8").astype(np.uint64)
+
+    if size is None:
+        return Share(int(values[0]))
+
+    return ShareVector(values)
+
+
+def seeded_triplet(seed: bytes, op_id: str, size: Optional[int] = None) -> Tuple[Union[Share, ShareVector], ...]:
+    """
+    Derive the shares of a, b and c of the triplet of an operation from the seed of a participant.
+    The c share of the designated participant is replaced by its correction.
+    """
+
+    return tuple(prg_share(seed, f"{op_id}/{name}", size) for name in ("a", "b", "c"))
+
+
+def seeded_mask(
+        seed: bytes,
+        owner_id: str,
+        secret_id: str,
+        size: Optional[int] = None
+) -> Union[Share, ShareVector]:
+    """
+    Derive the share of the mask of a secret from the seed of a participant.
+    `owner_id` is the participant holding the secret, the only one to which the mask is given.
+    """
+
+    return prg_share(seed, f"mask/{owner_id}/{secret_id}", size)
+
+
+def share_secret_with_seeds(
+        secret: Union[int, List[int]],
+        seeds: List[bytes],
+        label: str
+) -> Union[Share, ShareVector]:
+    """
+    Share a secret between the holders of the seeds, whose shares are derived with `prg_share`,
+    and the dealer. Return the share of the dealer, correcting the others so that they sum to the secret.
+    """
+
+    share = share_from_value(secret)
+    size = vector_size(share)
+
+    for seed in seeds:
+        share = share - prg_share(seed, label, size)
+
+    return share
+
+
 def add_mod(a, b) -> int:
     """Add modulo 2^64"""
 
-    return (a + b) % get_mod()
+    return (a + b) % max_nbr
 
 
 def sub_mod(a, b) -> int:
     """Sub modulo 2^64"""
 
-    return (a - b) % get_mod()
+    return (a - b) % max_nbr
 
 
 def mul_mod(a, b) -> int:
     """Mul modulo 2^64"""
 
-    return (a * b) % get_mod()
+    return (a * b) % max_nbr
 
 
 # size of the additive integer field
@@ -0,0 +1,169 @@
+"""
+Encoding of the shares and messages exchanged with the server.
+
+Shares are either encoded as JSON, or in a compact binary format where every field element takes
+8 bytes (little-endian uint64). Binary payloads start with a NUL byte, which a JSON payload never
+does, so they can be decoded without knowing which format the sender chose.
+"""
+
+import json
+import struct
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from secret_sharing import SEED_BYTES, Share, ShareVector, prg_share, share_from_value, share_value, to_uint64
+
+# content type of the requests and answers in the binary format
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
+BINARY_MARKER = b"\x00"
+# first byte of a bundle of shares derived from a seed, see `encode_seed_bundle`
+SEED_MARKER = b"\x01"
+
+
+def encode_shares(shares: List[Union[Share, ShareVector]], binary: bool = True) -> bytes:
+    """
+    Encode a list of shares.
+
+    The binary format is the marker, the number of shares as a uint32, the size of every share as an
+    int32 (-1 for a single Share), then the values of all the shares as little-endian uint64.
+    """
+
+    if not binary:
+        return json.dumps([share_value(share) for share in shares]).encode()
+
+    sizes = [len(share) if isinstance(share, ShareVector) else -1 for share in shares]
+    values = [share.values if isinstance(share, ShareVector) else to_uint64([share.value]) for share in shares]
+
+    return b"".join((
+        BINARY_MARKER,
+        struct.pack("<I", len(shares)),
+        np.array(sizes, dtype="<i4").tobytes(),
+        np.concatenate(values).astype("<u8").tobytes() if values else b"",
+    ))
+
+
+def decode_shares(data: bytes) -> List[Union[Share, ShareVector]]:
+    """
+    Decode a list of shares encoded by `encode_shares`, in either format.
+    """
+
+    if not data.startswith(BINARY_MARKER):
+        return [share_from_value(value) for value in json.loads(data)]
+
+    count, = struct.unpack_from("<I", data, 1)
+    sizes = np.frombuffer(data, dtype="<i4", count=count, offset=5)
+    values = np.frombuffer(data, dtype="<u8", offset=5 + 4 * count).astype(np.uint64)
+
+    shares = []
+    offset = 0
+    for size in sizes.tolist():
+        if size < 0:
+            shares.append(Share(int(values[offset])))
+            offset += 1
+        else:
+            shares.append(ShareVector(values[offset:offset + size]))
+            offset += size
+
+    return shares
+
+
+def encode_share_bundle(shares: Dict[str, Union[Share, ShareVector]], binary: bool = True) -> bytes:
+    """
+    Encode shares indexed by secret id, e.g. every share a party sends to one of its peers.
+
+    The binary format is the marker, then the shares encoded by `encode_shares` and packed by
+    `pack_messages` with their secret id as key.
+    """
+
+    if not binary:
+        return json.dumps({secret_id: share_value(share) for secret_id, share in shares.items()}).encode()
+
+    return BINARY_MARKER + pack_messages({
+        (secret_id,): encode_shares([share]) for secret_id, share in shares.items()
+    })
+
+
+def encode_seed_bundle(seed: bytes, sizes: Dict[str, Optional[int]], binary: bool = True) -> bytes:
+    """
+    Encode shares derived from a seed with `prg_share`, labelled by their secret id: only the seed
+    and the size of every share (None for a single Share) are sent.
+
+    The binary format is the seed marker, the seed, then the sizes as int32 (-1 for a single Share)
+    packed by `pack_messages` with their secret id as key.
+    """
+
+    if not binary:
+        return json.dumps({"seed": seed.hex(), "sizes": sizes}).encode()
+
+    return SEED_MARKER + seed + pack_messages({
+        (secret_id,): struct.pack("<i", -1 if size is None else size) for secret_id, size in sizes.items()
+    })
+
+
+def decode_share_bundle(data: bytes) -> Dict[str, Union[Share, ShareVector]]:
+    """
+    Decode shares encoded by `encode_share_bundle` or `encode_seed_bundle`, in either format.
+    """
+
+    if data.startswith(SEED_MARKER):
+        seed = data[1:1 + SEED_BYTES]
+        sizes = {secret_id: struct.unpack("<i", size)[0]
+                 for (secret_id,), size in unpack_messages(data[1 + SEED_BYTES:], 1).items()}
+        return {secret_id: prg_share(seed, secret_id, None if size < 0 else size) for secret_id, size in sizes.items()}
+
+    if not data.startswith(BINARY_MARKER):
+        bundle = json.loads(data)
+        if "seed" in bundle:
+            seed = bytes.fromhex(bundle["seed"])
+            return {secret_id: prg_share(seed, secret_id, size) for secret_id, size in bundle["sizes"].items()}
+        return {secret_id: share_from_value(value) for secret_id, value in bundle.items()}
+
+    return {secret_id: decode_shares(message)[0] for (secret_id,), message in unpack_messages(data[1:], 1).items()}
+
+
+def pack_messages(messages: Dict[Tuple[str, ...], bytes]) -> bytes:
+    """
+    Pack messages indexed by tuples of strings (e.g. sender and label) in a binary payload.
+
+    The payload is the number of messages as a uint32, then for each message the strings of its key,
+    each prefixed by its length as a uint16, and the message prefixed by its length as a uint32.
+    """
+
+    parts = [struct.pack("<I", len(messages))]
+
+    for key, message in messages.items():
+        for string in key:
+            encoded = string.encode()
+            parts.append(struct.pack("<H", len(encoded)))
+            parts.append(encoded)
+
+        parts.append(struct.pack("<I", len(message)))
+        parts.append(message)
+
+    return b"".join(parts)
+
+
+def unpack_messages(data: bytes, key_length: int) -> Dict[Tuple[str, ...], bytes]:
+    """
+    Unpack the messages packed by `pack_messages`, whose keys are tuples of `key_length` strings.
+    """
+
+    messages = dict()
+
+    count, = struct.unpack_from("<I", data, 0)
+    offset = 4
+
+    for _ in range(count):
+        key = []
+        for _ in range(key_length):
+            length, = struct.unpack_from("<H", data, offset)
+            key.append(data[offset + 2:offset + 2 + length].decode())
+            offset += 2 + length
+
+        length, = struct.unpack_from("<I", data, offset)
+        messages[tuple(key)] = data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+
+    return messages
@@ -3,31 +3,106 @@ Trusted server that should help SMC client to communicate.
 You should not need to change this file.
 """
 
+import base64
 import collections
+import json
+import logging
+import queue
+import random
+import socketserver
 import sys
+import threading
 from os import environ
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 from flask import Flask, request, Response, jsonify
+from werkzeug.serving import WSGIRequestHandler
 
+from communication import (
+    AGGREGATOR_ID,
+    DEFAULT_SESSION,
+    PUSH_PORT_OFFSET,
+    SESSION_HEADER,
+    recv_frame,
+    sanitize_url_param,
+    send_frame,
+)
+from secret_sharing import Share, share_value
+from serialization import BINARY_CONTENT_TYPE, decode_shares, encode_shares, pack_messages, unpack_messages
 from ttp import TrustedParamGenerator
 
 
 environ["WERKZEUG_RUN_MAIN"] = "true"
+logger = logging.getLogger(__name__)
 app: Flask = Flask("Trusted Third Party Server")
-store: Dict[str, Dict[Tuple[str, str], bytes]] = collections.defaultdict(dict)
+# session id -> pool -> channel -> message
+store: Dict[str, Dict[str, Dict[Tuple[str, str], bytes]]] = collections.defaultdict(lambda: collections.defaultdict(dict))
 ttp: TrustedParamGenerator = TrustedParamGenerator()
 
+# participants who must read a public message before it is deleted, as they appear in the channels
+# (all the registered ones, whatever the parties of the run, see `run`)
+participants: Set[str] = set()
+# session id -> channel of a public message -> participants who read it
+public_readers: Dict[str, Dict[Tuple[str, str], Set[str]]] = collections.defaultdict(
+    lambda: collections.defaultdict(set))
+
+# notified whenever a value is written in the store, to wake up the long-polling requests
+store_condition = threading.Condition()
+
+# pools in which the clients can write messages on the push transport
+PUSH_POOLS = ("private", "public")
+
+# session id -> label -> sum of the shares contributed to an opening, and the participants who contributed
+openings: Dict[str, Dict[str, Tuple[list, Set[str]]]] = collections.defaultdict(dict)
+
+# outgoing frames of the clients connected to the push transport, indexed by session and client id
+push_clients: Dict[Tuple[str, str], queue.Queue] = dict()
+
+# longest time a retrieval can wait for its value, in seconds
+MAX_POLL_TIMEOUT = 30.0
+# whether the retrievals can wait for their values, which needs a threaded server
+long_polling = True
+
+# number of requests answered, indexed by endpoint and status code
+request_counters: Dict[Tuple[str, int], int] = collections.Counter()
+counters_lock = threading.Lock()
+# fraction of the requests logged at the INFO level
+log_sample_rate = 0.0
+
+
+@app.after_request
+def count_request(response: Response) -> Response:
+    """
+    Count every request, and log a sample of them.
+    """
+    with counters_lock:
+        request_counters[(request.endpoint, response.status_code)] += 1
+
+    if log_sample_rate and random.random() < log_sample_rate:
+        logger.info("%s %s %d", request.method, request.full_path, response.status_code)
+
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    The counters of the requests answered by the server, and the metrics of the trusted party.
+    """
+    with counters_lock:
+        requests = [[endpoint, status, count] for (endpoint, status), count in request_counters.items()]
+    with store_condition:
+        messages = {session_id: sum(len(values) for values in pools.values()) for session_id, pools in store.items()}
+    return jsonify({"requests": requests, "messages": messages, "triplets": ttp.metrics()}), 200
+
 
 @app.route("/private/<sender_id>/<receiver_id>/<label>", methods=["POST"])
 def send_private_message(sender_id: str, receiver_id: str, label: str):
     """
     The client send a private message to the server.
     """
-    print(
-        f"[ SEND     ] SENDER {sender_id} / LABEL {label} / RECEIVER {receiver_id}"
-    )
-    _set_value("private", (receiver_id, label), request.get_data())
+    logger.debug("[ SEND     ] SENDER %s / LABEL %s / RECEIVER %s", sender_id, label, receiver_id)
+    _set_value(_session_id(), "private", (receiver_id, label), request.get_data())
     return Response(status=200)
 
 
@@ -35,10 +110,12 @@ def send_private_message(sender_id: str, receiver_id: str, label: str):
 def retrieve_private_message(receiver_id: str, label: str):
     """
     The client retrieve a private message from the server.
+    With a `timeout` query parameter, wait up to that many seconds for the message to be sent.
+    The message is deleted once retrieved.
     """
-    res = _get_value("private", (receiver_id, label))
+    res = _get_value(_session_id(), "private", (receiver_id, label), receiver_id, _poll_timeout())
     if res is not None:
-        print(f"[ RETRIEVE ] RECEIVER {receiver_id} / LABEL {label}")
+        logger.debug("[ RETRIEVE ] RECEIVER %s / LABEL %s", receiver_id, label)
         return res, 200
 
     return Response(status=404)
@@ -49,8 +126,8 @@ def publish_message(sender_id: str, label: str):
     """
     The client publish a public message on the server.
     """
-    print(f"[ PUBLISH  ] SENDER {sender_id} / LABEL {label}")
-    _set_value("public", (sender_id, label), request.get_data())
+    logger.debug("[ PUBLISH  ] SENDER %s / LABEL %s", sender_id, label)
+    _set_value(_session_id(), "public", (sender_id, label), request.get_data())
     return Response(status=200)
 
 
@@ -58,48 +135,460 @@ def publish_message(sender_id: str, label: str):
 def retrieve_public_message(receiver_id: str, sender_id: str, label: str):
     """
     The client retrieve a public message from the server.
+    With a `timeout` query parameter, wait up to that many seconds for the message to be published.
+    The message is deleted once retrieved by every other participant.
     """
-    res = _get_value("public", (sender_id, label))
+    res = _get_value(_session_id(), "public", (sender_id, label), receiver_id, _poll_timeout())
     if res is not None:
-        print(
-            f"[ RETRIEVE ] RECEIVER {receiver_id}. LABEL {label} / SENDER {sender_id}"
-        )
+        logger.debug("[ RETRIEVE ] RECEIVER %s. LABEL %s / SENDER %s", receiver_id, label, sender_id)
         return res, 200
     return Response(status=404)
 
 
+@app.route("/batch/public/<sender_id>", methods=["POST"])
+def publish_messages(sender_id: str):
+    """
+    The client publish many public messages on the server at once.
+    The body is a JSON object mapping each label to its message, or the messages packed in the
+    binary format of `serialization`.
+    """
+    if request.content_type == BINARY_CONTENT_TYPE:
+        messages = {label: message for (label,), message in unpack_messages(request.get_data(), 1).items()}
+    else:
+        messages = {label: message.encode() for label, message in request.get_json(force=True).items()}
+    logger.debug("[ PUBLISH  ] SENDER %s / %d LABELS", sender_id, len(messages))
+    _set_values(_session_id(), "public", {(sender_id, label): message for label, message in messages.items()})
+    return Response(status=200)
+
+
+@app.route("/batch/public/<receiver_id>", methods=["GET"])
+def retrieve_public_messages(receiver_id: str):
+    """
+    The client retrieve many public messages from the server at once.
+    The `channels` query parameter is a JSON list of [sender_id, label] pairs. The answer is a JSON
+    list of [sender_id, label, message] for the messages already published, the messages being base64
+    encoded since they may be binary whatever the format of the reader, or the messages packed in
+    the binary format if asked for. With a `timeout` query parameter, wait up to that many seconds for
+    all the messages to be published.
+    """
+    channels = [tuple(channel) for channel in json.loads(request.args["channels"])]
+    res = _get_values(_session_id(), "public", channels, receiver_id, _poll_timeout())
+    logger.debug("[ RETRIEVE ] RECEIVER %s / %d OF %d LABELS", receiver_id, len(res), len(channels))
+    if _accepts_binary():
+        return Response(pack_messages(res), status=200, content_type=BINARY_CONTENT_TYPE)
+    return jsonify([
+        [sender_id, label, base64.b64encode(message).decode()] for (sender_id, label), message in res.items()
+    ]), 200
+
+
 @app.route("/shares/<client_id>/<op_id>", methods=["GET"])
 def retrieve_share(client_id: str, op_id: str):
     """
     The client retrieve Beaver triplets generated by the server.
+    The optional `size` query parameter asks for a vector of triplets.
+    """
+    size = request.args.get("size", type=int)
+    shares = ttp.retrieve_share(client_id, _session_op_id(op_id), size)
+    if shares is None:
+        return _refused_triplets(client_id)
+    if _accepts_binary():
+        return Response(encode_shares(shares), status=200, content_type=BINARY_CONTENT_TYPE)
+    return jsonify([share_value(share) for share in shares]), 200
+
+
+@app.route("/shares/<client_id>", methods=["POST"])
+def retrieve_shares(client_id: str):
+    """
+    The client retrieve the Beaver triplets of many operations at once.
+    The body is a JSON list of [op_id, size] pairs, size being null for single triplets.
+    In the binary format, the answer is the flat list of the shares of all the triplets.
+    """
+    ops = request.get_json(force=True)
+    triplets = ttp.retrieve_shares(client_id, [(_session_op_id(op_id), size) for op_id, size in ops])
+    if triplets is None:
+        return _refused_triplets(client_id)
+    if _accepts_binary():
+        shares = [share for triplet in triplets for share in triplet]
+        return Response(encode_shares(shares), status=200, content_type=BINARY_CONTENT_TYPE)
+    return jsonify([[share_value(share) for share in shares] for shares in triplets]), 200
+
+
+@app.route("/seeds/<client_id>", methods=["GET"])
+def retrieve_seed(client_id: str):
     """
-    shares = ttp.retrieve_share(client_id, op_id)
-    return jsonify((shares[0].value, shares[1].value, shares[2].value)), 200
+    The client retrieve the seed from which it derives its shares of the Beaver triplets and of
+    the input masks of its session. The answer is a JSON object with the hex `seed`, and `designated` telling if the client
+    must retrieve the corrections of its c shares.
+    """
+    res = ttp.retrieve_seed(client_id, _session_id())
+    if res is None:
+        return Response(status=403)
+    seed, designated = res
+    return jsonify({"seed": seed.hex(), "designated": designated}), 200
+
+
+@app.route("/seeds/<client_id>/corrections", methods=["POST"])
+def retrieve_corrections(client_id: str):
+    """
+    The designated client retrieve the c shares of the Beaver triplets derived from the seeds.
+    The body is a JSON list of [op_id, size] pairs, size being null for single triplets.
+    """
+    ops = request.get_json(force=True)
+    corrections = ttp.retrieve_corrections(client_id, _session_id(), ops)
+    if corrections is None:
+        return Response(status=403)
+    if _accepts_binary():
+        return Response(encode_shares(corrections), status=200, content_type=BINARY_CONTENT_TYPE)
+    return jsonify([share_value(share) for share in corrections]), 200
+
+
+@app.route("/masks/<client_id>", methods=["POST"])
+def retrieve_masks(client_id: str):
+    """
+    The client retrieve the masks of its secrets, whose shares are derived from the seeds.
+    The body is a JSON list of [secret_id, size] pairs, size being null for single values.
+    """
+    secrets = request.get_json(force=True)
+    masks = ttp.retrieve_masks(client_id, _session_id(), secrets)
+    if masks is None:
+        return Response(status=403)
+    if _accepts_binary():
+        return Response(encode_shares(masks), status=200, content_type=BINARY_CONTENT_TYPE)
+    return jsonify([share_value(share) for share in masks]), 200
 
 
-def _set_value(pool: str, channel: Tuple[str, str], data: bytes) -> None:
+@app.route("/open/<client_id>/<label>", methods=["POST"])
+def contribute_opening(client_id: str, label: str):
+    """
+    The client send its shares of values to open under a label, encoded by `serialization`.
+    Once every participant sent its shares, their sum is published for everyone to retrieve.
+    """
+    if client_id not in participants:
+        return Response(status=403)
+
+    shares = decode_shares(request.get_data())
+    session_id = _session_id()
+    logger.debug("[ OPEN     ] SENDER %s / LABEL %s", client_id, label)
+
+    with store_condition:
+        total, contributors = openings[session_id].setdefault(label, ([Share(0)] * len(shares), set()))
+        if len(total) != len(shares) or client_id in contributors:
+            return Response(status=400)
+
+        total[:] = [t + share for t, share in zip(total, shares)]
+        contributors.add(client_id)
+
+        if contributors >= participants:
+            del openings[session_id][label]
+            if not openings[session_id]:
+                del openings[session_id]
+            _set_value(session_id, "opened", (AGGREGATOR_ID, label), encode_shares(total))
+
+    return Response(status=200)
+
+
+@app.route("/open/<client_id>/<label>", methods=["GET"])
+def retrieve_opening(client_id: str, label: str):
+    """
+    The client retrieve the values opened under a label, the sums of the shares of every participant.
+    With a `timeout` query parameter, wait up to that many seconds for every share to be sent.
+    The values are deleted once retrieved by every participant.
+    """
+    res = _get_value(_session_id(), "opened", (AGGREGATOR_ID, label), client_id, _poll_timeout())
+    if res is None:
+        return Response(status=404)
+
+    logger.debug("[ RETRIEVE ] RECEIVER %s / OPENED %s", client_id, label)
+    if _accepts_binary():
+        return Response(res, status=200, content_type=BINARY_CONTENT_TYPE)
+    return encode_shares(decode_shares(res), binary=False), 200
+
+
+class PushHandler(socketserver.StreamRequestHandler):
+    """
+    Persistent connection of a client to the push transport.
+
+    The first frame of the client holds ("hello", client_id, session_id). The server then pushes every
+    private message sent to the client, every public message of the other clients and the opened
+    values, including the ones stored before the connection, and stores the messages sent by the
+    client on the connection. Messages pushed count as retrieved.
+    """
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        hello = recv_frame(self.rfile)
+        if not hello:
+            return
+        (_, client_id, session_id), = hello.keys()
+        logger.info("[ CONNECT  ] CLIENT %s / SESSION %s", client_id, session_id)
+
+        # frames are written by another thread, so that a slow client does not block the store
+        outbox = queue.Queue()
+        writer = threading.Thread(target=_write_frames, args=(self.wfile, outbox), daemon=True)
+        writer.start()
+        _subscribe(session_id, client_id, outbox)
+
+        try:
+            while True:
+                frame = recv_frame(self.rfile)
+                if frame is None:
+                    break
+
+                values = collections.defaultdict(dict)
+                for (pool, channel, label), message in frame.items():
+                    # the other pools are only written by the server, e.g. the opened values
+                    if pool not in PUSH_POOLS:
+                        logger.warning("[ PUSH     ] SENDER %s / DROPPED POOL %s", client_id, pool)
+                        continue
+                    # public messages can only be published by the client itself
+                    values[pool][(client_id if pool == "public" else channel, label)] = message
+
+                logger.debug("[ PUSH     ] SENDER %s / %d MESSAGES", client_id, len(frame))
+                for pool, pool_values in values.items():
+                    _set_values(session_id, pool, pool_values)
+        except OSError:
+            pass
+        finally:
+            _unsubscribe(session_id, client_id, outbox)
+            outbox.put(None)
+            writer.join()
+
+
+class PushServer(socketserver.ThreadingTCPServer):
+    """
+    Server of the push transport, one thread per connected client.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def _subscribe(session_id: str, client_id: str, outbox: queue.Queue) -> None:
+    """
+    Register the outbox of a client connected to the push transport, with the messages already stored.
+    """
+    with store_condition:
+        push_clients[(session_id, client_id)] = outbox
+        for pool in ("private", "public", "opened"):
+            _push(session_id, pool, dict(store[session_id][pool]), {(session_id, client_id): outbox})
+
+
+def _unsubscribe(session_id: str, client_id: str, outbox: queue.Queue) -> None:
+    """
+    Unregister the outbox of a client disconnected from the push transport.
+    """
+    with store_condition:
+        if push_clients.get((session_id, client_id)) is outbox:
+            del push_clients[(session_id, client_id)]
+
+
+def _push(
+        session_id: str,
+        pool: str,
+        values: Dict[Tuple[str, str], bytes],
+        outboxes: Dict[Tuple[str, str], queue.Queue]
+) -> None:
+    """
+    Queue the values of a pool to the clients of the session who should receive them: the receiver of
+    a private message, everyone but the sender of a public or opened one.
+    """
+    for (client_session_id, client_id), outbox in list(outboxes.items()):
+        if client_session_id != session_id:
+            continue
+
+        if pool == "private":
+            frame = {(pool, channel, label): data for (channel, label), data in values.items() if channel == client_id}
+        else:
+            frame = {(pool, channel, label): data for (channel, label), data in values.items() if channel != client_id}
+
+        if frame:
+            outbox.put(frame)
+            _consume(session_id, pool, [(channel, label) for _, channel, label in frame], client_id)
+
+
+def _write_frames(wfile, outbox: queue.Queue) -> None:
+    """
+    Write the frames of an outbox on a push connection, until None is queued.
+    """
+    while True:
+        frame = outbox.get()
+        if frame is None:
+            return
+        try:
+            send_frame(wfile, frame)
+        except OSError:
+            return
+
+
+def _set_value(session_id: str, pool: str, channel: Tuple[str, str], data: bytes) -> None:
     """
     Push data to a channel in a given pool and send an event.
     """
-    store[pool][channel] = data
+    _set_values(session_id, pool, {channel: data})
 
 
-def _get_value(pool: str, channel: Tuple[str, str]) -> Optional[bytes]:
+def _set_values(session_id: str, pool: str, values: Dict[Tuple[str, str], bytes]) -> None:
+    """
+    Push data to many channels in a given pool and send a single event.
+    """
+    with store_condition:
+        store[session_id][pool].update(values)
+        _push(session_id, pool, values, push_clients)
+        store_condition.notify_all()
+
+
+def _get_value(
+        session_id: str,
+        pool: str,
+        channel: Tuple[str, str],
+        reader_id: str,
+        timeout: float = 0
+) -> Optional[bytes]:
     """
     Subscribe to a channel in a given pool and get it once ready.
+    Wait up to `timeout` seconds for the value, return None if it is still not there.
+    """
+    values = _get_values(session_id, pool, [channel], reader_id, timeout)
+    return values.get(channel)
+
+
+def _get_values(
+        session_id: str,
+        pool: str,
+        channels: List[Tuple[str, str]],
+        reader_id: str,
+        timeout: float = 0
+) -> Dict[Tuple[str, str], bytes]:
+    """
+    Subscribe to many channels in a given pool and get them once ready.
+    Wait up to `timeout` seconds for all the values, and return the ones that are there.
     """
-    if channel not in store[pool]:
-        return None
-    return store[pool][channel]
+    with store_condition:
+        store_condition.wait_for(lambda: all(channel in store[session_id][pool] for channel in channels), timeout)
+        values = {channel: store[session_id][pool][channel] for channel in channels if channel in store[session_id][pool]}
+        _consume(session_id, pool, list(values), reader_id)
+        return values
 
 
-def run(host: str, port: int, participants: List[str]) -> None:
+def _consume(session_id: str, pool: str, channels: List[Tuple[str, str]], reader_id: str) -> None:
+    """
+    Record that a client read messages: a private message is deleted once read by its receiver, a
+    public or opened one once read by every participant but its sender. The namespace of a session is deleted
+    with its last message. Must be called with `store_condition` held.
+    The readers are counted against every registered participant, not the parties of the run.
+    """
+    values = store[session_id][pool]
+    readers = public_readers[session_id]
+
+    for channel in channels:
+        if pool == "private":
+            if channel[0] == reader_id:
+                del values[channel]
+        elif channel[0] != reader_id:
+            readers[channel].add(reader_id)
+            if readers[channel] >= participants - {channel[0]}:
+                del values[channel]
+                del readers[channel]
+
+    if not any(store[session_id].values()):
+        del store[session_id]
+        public_readers.pop(session_id, None)
+
+
+def _session_id() -> str:
+    """
+    Return the session of the protocol run the request belongs to.
+    """
+    return request.headers.get(SESSION_HEADER, DEFAULT_SESSION)
+
+
+def _refused_triplets(client_id: str) -> Response:
+    """
+    Answer a refused retrieval of Beaver triplets: 403 if the client is not a participant, 410 if the
+    triplets of an operation were evicted, a new triplet being inconsistent with the shares of the others.
+    """
+    if client_id not in participants:
+        return Response(status=403)
+    logger.warning("refused triplets of evicted operations to %s", client_id)
+    return Response(status=410)
+
+
+def _session_op_id(op_id: str) -> str:
+    """
+    Return the id under which the trusted party knows an operation of the session of the request.
+    """
+    return f"{_session_id()}/{op_id}"
+
+
+def _accepts_binary() -> bool:
+    """
+    Tell if the client asked for answers in the binary format.
+    """
+    return BINARY_CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+def _poll_timeout() -> float:
+    """
+    Return the long-polling timeout asked by the request, 0 if it should not wait.
+    """
+    if not long_polling:
+        return 0
+    timeout = request.args.get("timeout", default=0, type=float)
+    return min(max(timeout, 0), MAX_POLL_TIMEOUT)
+
+
+def run(
+        host: str,
+        port: int,
+        participant_ids: List[str],
+        max_triplet_ops: Optional[int] = None,
+        threaded: bool = True,
+        log_level: int = logging.WARNING,
+        request_log_sample_rate: float = 0.0
+) -> None:
     """
     Register the participants, then run the server.
+    The messages of each protocol run (session) are kept apart, and deleted once read by the
+    participants who should read them, so that runs can follow each other on the same server.
+    A public message is deleted once read by every registered participant but its sender: the public
+    messages of a run between a subset of the participants are never deleted, and neither is its
+    session. The same goes for the address published by a peer-to-peer party when the circuit is
+    public, which no peer reads.
+    `max_triplet_ops` caps the number of operations whose triplets are kept by the trusted party.
+    The push transport listens on `port + PUSH_PORT_OFFSET`.
+
+    With `threaded`, the requests are served concurrently. Otherwise they are served one at a time,
+    the retrievals answer at once instead of long polling, and every connection is closed after
+    its request so that no client holds the server.
+
+    Nothing is logged per request below the DEBUG `log_level`, but a `request_log_sample_rate`
+    fraction of the requests is logged at the INFO level. The counters of the requests are served
+    on /metrics.
     """
-    for participant in participants:
+    global long_polling, log_sample_rate
+
+    logging.basicConfig(level=log_level, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    # the request log of werkzeug writes a line per request, the sampled log replaces it
+    logging.getLogger("werkzeug").setLevel(max(log_level, logging.WARNING))
+    log_sample_rate = request_log_sample_rate
+
+    ttp.max_ops = max_triplet_ops
+    for participant in participant_ids:
         ttp.add_participant(participant)
-    app.run(host, port, threaded=False, processes=1)
+        participants.add(sanitize_url_param(participant))
+
+    push_server = PushServer((host, port + PUSH_PORT_OFFSET), PushHandler)
+    threading.Thread(target=push_server.serve_forever, daemon=True).start()
+
+    long_polling = threaded
+    if threaded:
+        # keep-alive connections, so that the clients reuse their connections across requests,
+        # without Nagle's algorithm delaying the small responses written on them
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        WSGIRequestHandler.disable_nagle_algorithm = True
+    # threaded, so that the long-polling requests do not block the others
+    app.run(host, port, threaded=threaded, processes=1)
 
 
 def main(args: List[str]) -> None:
@@ -4,26 +4,51 @@ Implementation of an SMC client.
 MODIFY THIS FILE.
 """
 
+import asyncio
 import time
-import sys
 from typing import (
     Dict,
-    Set,
+    List,
+    Optional,
     Tuple,
     Union
 )
 
-from communication import Communication
-from expression import Addition, Expression, Multiplication, Scalar, Secret, Substraction
+from communication import AsyncCommunication, Communication, PeerCommunication, PushCommunication
+from expression import (
+    Addition,
+    Expression,
+    Multiplication,
+    Scalar,
+    Secret,
+    Substraction,
+    balance,
+    fold_constants,
+    multiplication_layers,
+)
 from protocol import ProtocolSpec
+from serialization import (
+    decode_share_bundle,
+    decode_shares,
+    encode_seed_bundle,
+    encode_share_bundle,
+    encode_shares,
+)
 from secret_sharing import (
-    reconstruct_secret,
+    new_seed,
+    seeded_mask,
+    seeded_triplet,
+    share_from_value,
     share_secret,
+    share_secret_with_seeds,
+    share_secrets,
+    share_value,
+    max_size,
+    vector_size,
     Share,
+    ShareVector,
 )
 
-sys.setrecursionlimit(1500)
-
 # Feel free to add as many imports as you want.
 
 class SMCParty:
@@ -37,6 +62,20 @@ class SMCParty:
         server_port: port of the server
         protocol_spec (ProtocolSpec): Protocol specification
         value_dict (dict): Dictionary assigning values to secrets belonging to this client.
+            A value can be a list of ints to compute the circuit element-wise over a batch.
+        binary: send the shares in the compact binary format of `serialization` rather than in JSON
+        push: receive the messages pushed by the server on a persistent connection rather than polling
+        p2p: send the messages directly to the other clients, the server being only used to find them
+            and for the Beaver triplets
+        prg_sharing: send the other clients a seed from which they derive their shares of our secrets,
+            rather than the shares themselves
+        prg_triplets: derive the Beaver triplets from a seed sent by the server rather than receiving
+            their shares, every client of the protocol must use the same option
+        input_masks: publish our secrets masked by masks dealt by the server, rather than sending
+            their shares to every other client, every client of the protocol must use the same option
+        aggregate_openings: let the server sum the shares of the values to open and publish them once,
+            rather than retrieving the shares of every other client, every client of the protocol must
+            use the same option
     """
 
     def __init__(
@@ -45,57 +84,82 @@ class SMCParty:
             server_host: str,
             server_port: int,
             protocol_spec: ProtocolSpec,
-            value_dict: Dict[Secret, int]
+            value_dict: Dict[Secret, Union[int, List[int]]],
+            binary: bool = True,
+            push: bool = False,
+            p2p: bool = False,
+            prg_sharing: bool = False,
+            prg_triplets: bool = False,
+            input_masks: bool = False,
+            aggregate_openings: bool = False
     ):
 
-        self.comm = Communication(server_host, server_port, client_id)
+        # one connection per concurrent request to the server
+        options = dict(
+            pool_size=len(protocol_spec.participant_ids),
+            binary=binary,
+            session_id=protocol_spec.session_id
+        )
+        if p2p:
+            self.comm = PeerCommunication(
+                server_host, server_port, client_id, peer_ids=protocol_spec.participant_ids, **options)
+        elif push:
+            self.comm = PushCommunication(server_host, server_port, client_id, **options)
+        else:
+            self.comm = Communication(server_host, server_port, client_id, **options)
+        # retrievals from the other participants are waited for concurrently
+        self.async_comm = AsyncCommunication(self.comm, max_workers=len(protocol_spec.participant_ids))
 
         self.client_id = client_id
         self.protocol_spec = protocol_spec
+        self.binary = binary
+        self.prg_sharing = prg_sharing
+        self.prg_triplets = prg_triplets
+        self.input_masks = input_masks
+        self.aggregate_openings = aggregate_openings
+
+        # left-deep chains are rebalanced to reduce the number of multiplication rounds
+        # and the public sub-expressions are computed once for all
+        self.expr = fold_constants(balance(protocol_spec.expr))
         self.value_dict = value_dict
 
         self.secrets = list(value_dict.keys())
 
         self.own_shares = dict()
 
-    def run(self) -> int:
-        """
-        The method the client use to do the SMC.
-        """
-
-        start = time.time() * 1000
-
-        # Share secrets across participants
-        for s in self.secrets:
-            shares = share_secret(self.value_dict[s], len(self.protocol_spec.participant_ids))
-
-            for i, pid in enumerate(self.protocol_spec.participant_ids):
-
-                if pid != self.client_id:
-                    # Publish shares for other participants
-                    self.comm.send_private_message(pid, str(s.get_id_int()), str(shares[i].value))
-                else:
-                    # Keep own share in dict
-                    self.own_shares[str(s.get_id_int())] = shares[i]
+        # shares of the secret multiplications, indexed by id of the expression
+        self.mult_shares = dict()
 
-        # compute locally share of the final value
-        final_share = self.process_expression(self.protocol_spec.expr).value
+        # pool of Beaver triplets shares, indexed by id of the multiplication
+        self.triplets = dict()
 
-        # send final share to others
-        self.comm.publish_message("final", str(final_share))
+        # seed sent by the server, and whether we are designated for the corrections of the triplets
+        self.seed: Optional[Tuple[bytes, bool]] = None
 
-        # put every share of the circuit together
-        final_result = Share(final_share)
+    def run(self) -> Union[int, List[int]]:
+        """
+        The method the client use to do the SMC.
+        """
 
-        for pid in self.protocol_spec.participant_ids:
+        return asyncio.run(self.run_async())
 
-            if pid != self.client_id:
-                remote_share = self.comm.retrieve_public_message(pid, "final")
+    async def run_async(self) -> Union[int, List[int]]:
+        """
+        Asynchronous version of `run`, to call from a running event loop.
+        """
 
-                while remote_share is None:  # retry if not yet here
+        start = time.time() * 1000
 
-                    remote_share = self.comm.retrieve_public_message(pid, "final")
-                final_result += Share(int(remote_share))
+        try:
+            if self.expr.is_public:
+                # the whole circuit folded into a Scalar, no share needs to be exchanged
+                # (adding zero reduces the value modulo 2^64)
+                final_result = share_value(share_from_value(self.expr.value) + Share(0))
+            else:
+                final_result = await self.compute_secret_circuit()
+        finally:
+            # no socket, reader thread or worker left behind, nor a subscription on the server
+            self.async_comm.close()
 
         stop = time.time() * 1000
 
@@ -114,96 +178,303 @@ class SMCParty:
                 total_bytes_received)+"\n")
             res_file.close()
 
-        return final_result.value
+        return final_result
+
+    async def compute_secret_circuit(self) -> Union[int, List[int]]:
+        """Share the secrets, then compute the circuit with the other parties"""
+
+        if self.input_masks:
+            await self.share_masked_inputs()
+        else:
+            # Share secrets across participants, with a single bundle of shares per participant
+            # every other participant gets a bundle, even an empty one, so that it knows what to wait for
+            await self.async_comm.gather(*(
+                self.async_comm.send_private_message(pid, input_label(self.client_id), bundle)
+                for pid, bundle in self.share_inputs().items()
+            ))
+
+            # retrieve the shares of the secrets of the others
+            await self.fetch_secret_shares()
+
+        layers = multiplication_layers(self.expr)
+
+        # preprocessing: fetch every Beaver triplet of the circuit before computing it
+        await self.prefetch_triplets(layers)
+
+        # compute the secret multiplications layer by layer, one opening round per layer
+        for round_nbr, layer in enumerate(layers):
+            await self.process_layer(round_nbr, layer)
+
+        # compute locally share of the final value
+        final_share = self.process_expression(self.expr)
+
+        # put every share of the circuit together
+        return share_value((await self.open_shares("final", [final_share]))[0])
+
+    def share_inputs(self) -> Dict[str, bytes]:
+        """Share our secrets, keep our shares and return the encoded bundle of every other participant"""
+
+        peers = [pid for pid in self.protocol_spec.participant_ids if pid != self.client_id]
+
+        if self.prg_sharing:
+            # the shares of the others are derived from a seed each, we keep the correction
+            seeds = {pid: new_seed() for pid in peers}
+            sizes = dict()
+            for s in self.secrets:
+                secret_id = str(s.get_id_int())
+                self.own_shares[secret_id] = share_secret_with_seeds(self.value_dict[s], list(seeds.values()), secret_id)
+                sizes[secret_id] = vector_size(self.own_shares[secret_id])
+
+            return {pid: encode_seed_bundle(seeds[pid], sizes, self.binary) for pid in peers}
+
+        bundles = {pid: dict() for pid in self.protocol_spec.participant_ids}
+        for s in self.secrets:
+            if isinstance(self.value_dict[s], (list, tuple)):
+                shares = share_secrets(self.value_dict[s], len(self.protocol_spec.participant_ids))
+            else:
+                shares = share_secret(self.value_dict[s], len(self.protocol_spec.participant_ids))
+
+            for i, pid in enumerate(self.protocol_spec.participant_ids):
+                bundles[pid][str(s.get_id_int())] = shares[i]
+
+        # Keep own shares in dict
+        self.own_shares.update(bundles.pop(self.client_id))
+
+        return {pid: encode_share_bundle(bundle, self.binary) for pid, bundle in bundles.items()}
+
+    async def share_masked_inputs(self) -> None:
+        """
+        Publish our secrets minus the masks dealt by the server, and derive our share of every secret:
+        our share of its mask, plus the published value for the first participant.
+        """
+
+        secret_ids = [str(s.get_id_int()) for s in self.secrets]
+        values = [share_from_value(self.value_dict[s]) for s in self.secrets]
+
+        masked = dict()
+        if self.secrets:
+            masks = await self.async_comm.retrieve_input_masks(
+                [(secret_id, vector_size(value)) for secret_id, value in zip(secret_ids, values)])
+            masked = {secret_id: value - mask for secret_id, value, mask in zip(secret_ids, values, masks)}
+
+        # everyone publishes, even nothing, so that the others know what to wait for
+        await self.async_comm.publish_message(MASKED_INPUTS_LABEL, encode_share_bundle(masked, self.binary))
+
+        peers = [pid for pid in self.protocol_spec.participant_ids if pid != self.client_id]
+        messages, (seed, _) = await self.async_comm.gather(
+            self.async_comm.retrieve_public_messages([(pid, MASKED_INPUTS_LABEL) for pid in peers]),
+            self.get_seed()
+        )
+
+        # the masks are bound to the owner of the secret, the participant who published it
+        owners = {secret_id: self.client_id for secret_id in masked}
+        for (pid, _), message in messages.items():
+            bundle = decode_share_bundle(message)
+            owners.update((secret_id, pid) for secret_id in bundle)
+            masked.update(bundle)
+
+        for secret_id, value in masked.items():
+            share = seeded_mask(seed, owners[secret_id], secret_id, vector_size(value))
+            if self.client_id == self.protocol_spec.participant_ids[0]:
+                share = share + value
+            self.own_shares[secret_id] = share
+
+    async def get_seed(self) -> Tuple[bytes, bool]:
+        """Return the seed sent by the server, retrieving it the first time"""
+
+        if self.seed is None:
+            self.seed = await self.async_comm.retrieve_seed()
+
+        return self.seed
 
-    # Suggestion: To process expressions, make use of the *visitor pattern* like so:
     def process_expression(
             self,
             expr: Expression,
             secret_in_mult=False
-    ) -> Share:
+    ) -> Union[Share, ShareVector]:
+        """Compute the local share of an expression with an iterative post-order traversal"""
+
+        results = dict()  # (id(node), secret_in_mult) -> share of the node
 
-        if isinstance(expr, Addition):  # if expr is an addition operation:
-            return self.process_expression(expr.e1) + self.process_expression(expr.e2)
+        stack = [(expr, secret_in_mult, None)]
+        while stack:
+            node, in_mult, children_in_mult = stack.pop()
+            key = (id(node), in_mult)
 
-        if isinstance(expr, Substraction):  # if expr is an addition operation:
-            return self.process_expression(expr.e1) - self.process_expression(expr.e2)
+            if key in results:
+                continue
 
-        if isinstance(expr, Multiplication):
-            if self.contains_secret(expr.e1) and self.contains_secret(expr.e2):
+            if isinstance(node, Secret):
+                results[key] = self.get_secret_share(node)
 
-                x = self.process_expression(expr.e1, True)
-                y = self.process_expression(expr.e2, True)
+            elif isinstance(node, Scalar):
+                # scalar should only be added by one participant in case of addition
+                if (self.protocol_spec.participant_ids[0] != self.client_id) and (not in_mult):
+                    results[key] = Share(0)
+                else:
+                    results[key] = share_from_value(node.value)
+
+            elif isinstance(node, Multiplication) and not node.e1.is_public and not node.e2.is_public:
+                # already computed during the round of its multiplicative layer
+                results[key] = self.mult_shares[id(node)]
 
-                x_minus_a, y_minus_b, c = self.get_beaver_shares(x, y, expr)
+            elif children_in_mult is not None:
+                x = results[(id(node.e1), children_in_mult)]
+                y = results[(id(node.e2), children_in_mult)]
 
-                if self.client_id == self.protocol_spec.participant_ids[0]:  # participant 0 add the constant
-                    return c + x * y_minus_b + y * x_minus_a - x_minus_a * y_minus_b
+                if isinstance(node, Addition):
+                    results[key] = x + y
+                elif isinstance(node, Substraction):
+                    results[key] = x - y
                 else:
-                    return c + x * y_minus_b + y * x_minus_a
+                    results[key] = x * y
+
             else:
-                secret_mult = self.contains_secret(expr.e1) or self.contains_secret(expr.e2) or secret_in_mult
+                if isinstance(node, Multiplication):
+                    children_in_mult = not node.is_public or in_mult
+                else:
+                    children_in_mult = False
 
-                return self.process_expression(expr.e1, secret_mult) * self.process_expression(expr.e2, secret_mult)
+                stack.append((node, in_mult, children_in_mult))
+                stack.append((node.e2, children_in_mult, None))
+                stack.append((node.e1, children_in_mult, None))
 
-        if isinstance(expr, Secret):
-            if str(expr.get_id_int()) in self.own_shares.keys():
-                return self.own_shares[str(expr.get_id_int())]
-            else:
-                return Share(self.search_share(expr.get_id_int()))
+        return results[(id(expr), secret_in_mult)]
 
-        if isinstance(expr, Scalar):
-            # scalar should only be added by one participant in case of addition
-            if (self.protocol_spec.participant_ids[0] != self.client_id) and (not secret_in_mult):
-                return Share(0)
-            else:
-                return Share(expr.value)
+    def get_secret_share(self, secret: Secret) -> Union[Share, ShareVector]:
+        """Return our share of a secret"""
+        return self.own_shares[str(secret.get_id_int())]
 
-    def search_share(self, expr_id) -> int:
-        """Search for corresponding secret on the server"""
-        return int(self.comm.retrieve_private_message(str(expr_id)))
-      
+    async def fetch_secret_shares(self) -> None:
+        """Retrieve concurrently the bundle of shares of every other participant"""
 
-    def get_beaver_shares(self, x, y, expr):
+        peers = [pid for pid in self.protocol_spec.participant_ids if pid != self.client_id]
 
-        op_id_str = str(expr.get_id_int())
+        messages = await self.async_comm.gather(
+            *(self.async_comm.retrieve_private_message(input_label(pid)) for pid in peers))
 
-        a, b, c = self.comm.retrieve_beaver_triplet_shares(op_id_str)
+        for message in messages:
+            self.own_shares.update(decode_share_bundle(message))
 
-        # send to others shares of x-a and y-b
-        x_minus_a_share = x - Share(a)
-        y_minus_b_share = y - Share(b)
+    async def process_layer(self, round_nbr: int, layer: List[Multiplication]) -> None:
+        """Compute every secret multiplication of a layer with a single opening round"""
 
-        self.comm.publish_message(self.client_id + "x_minus_a_" + op_id_str, str(x_minus_a_share.value))
-        self.comm.publish_message(self.client_id + "y_minus_b_" + op_id_str, str(y_minus_b_share.value))
+        operands = [(self.process_expression(m.e1, True), self.process_expression(m.e2, True)) for m in layer]
+        triplets = [self.triplets.pop(id(m)) for m in layer]
 
-        # reconstruct x-a and y-b
+        # shares of x-a and y-b of every multiplication of the layer
+        masked = []
+        for (x, y), (a, b, _) in zip(operands, triplets):
+            masked.append(x - a)
+            masked.append(y - b)
 
-        x_shares = x_minus_a_share
-        y_shares = y_minus_b_share
+        opened = await self.open_shares("beaver_round_" + str(round_nbr), masked)
 
-        for pid in self.protocol_spec.participant_ids:
+        for i, expr in enumerate(layer):
+            x, y = operands[i]
+            x_minus_a, y_minus_b = opened[2 * i], opened[2 * i + 1]
+            c = triplets[i][2]
 
-            if pid != self.client_id:
+            res = c + x * y_minus_b + y * x_minus_a
 
-                curr_x = self.comm.retrieve_public_message(pid, pid + "x_minus_a_" + op_id_str)
-                curr_y = self.comm.retrieve_public_message(pid, pid + "y_minus_b_" + op_id_str)
+            if self.client_id == self.protocol_spec.participant_ids[0]:  # participant 0 add the constant
+                res = res - x_minus_a * y_minus_b
 
-                while curr_x is None:  # wait for others to upload their shares
-                    curr_x = self.comm.retrieve_public_message(pid, pid + "x_minus_a_" + op_id_str)
+            self.mult_shares[id(expr)] = res
 
-                while curr_y is None:
-                    curr_y = self.comm.retrieve_public_message(pid, pid + "y_minus_b_" + op_id_str)
+    async def prefetch_triplets(self, layers: List[List[Multiplication]]) -> None:
+        """Fetch the Beaver triplets of all the multiplications with a single request to the server"""
 
-                x_shares += Share(int(curr_x))
-                y_shares += Share(int(curr_y))
+        mults = [m for layer in layers for m in layer]
 
-        return x_shares, y_shares, Share(c)
+        if not mults:
+            return
 
-    def contains_secret(self, expr):
-        if isinstance(expr, Secret):
-            return True
-        elif isinstance(expr, Scalar):
-            return False
+        # multiplications of vectors need one triplet per element
+        sizes = self.vector_sizes()
+        ops = [(str(m.get_id_int()), sizes[id(m)]) for m in mults]
+
+        if self.prg_triplets:
+            triplets = await self.derive_triplets(ops)
         else:
-            return self.contains_secret(expr.e1) or self.contains_secret(expr.e2)
+            triplets = await self.async_comm.retrieve_beaver_triplets_shares(ops)
+
+        for m, triplet in zip(mults, triplets):
+            self.triplets[id(m)] = triplet
+
+    async def derive_triplets(
+            self,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> List[Tuple[Union[Share, ShareVector], ...]]:
+        """Derive the Beaver triplets of the operations from our seed, with the corrections if we are designated"""
+
+        seed, designated = await self.get_seed()
+        triplets = [seeded_triplet(seed, op_id, size) for op_id, size in ops]
+
+        if designated:
+            corrections = await self.async_comm.retrieve_triplet_corrections(ops)
+            triplets = [(a, b, c) for (a, b, _), c in zip(triplets, corrections)]
+
+        return triplets
+
+    def vector_sizes(self) -> Dict[int, Optional[int]]:
+        """Compute the vector size of every node of the circuit, None for single values"""
+
+        sizes = dict()  # id(node) -> size
+
+        stack = [(self.expr, False)]
+        while stack:
+            node, children_done = stack.pop()
+
+            if id(node) in sizes:
+                continue
+
+            if isinstance(node, Secret):
+                sizes[id(node)] = vector_size(self.get_secret_share(node))
+
+            elif isinstance(node, Scalar):
+                sizes[id(node)] = vector_size(share_from_value(node.value))
+
+            elif children_done:
+                sizes[id(node)] = max_size(sizes[id(node.e1)], sizes[id(node.e2)])
+
+            else:
+                stack.append((node, True))
+                stack.append((node.e2, False))
+                stack.append((node.e1, False))
+
+        return sizes
+
+    async def open_shares(
+            self,
+            label: str,
+            shares: List[Union[Share, ShareVector]]
+    ) -> List[Union[Share, ShareVector]]:
+        """Publish our shares under a label and reconstruct the values with the shares of the others"""
+
+        if self.aggregate_openings:
+            # the server sums the shares of everyone, and we only read the sums
+            await self.async_comm.contribute_opening(label, encode_shares(shares, self.binary))
+            return decode_shares(await self.async_comm.retrieve_opening(label))
+
+        await self.async_comm.publish_message(label, encode_shares(shares, self.binary))
+
+        # retrieve the shares of every other participant in a single request
+        peers = [pid for pid in self.protocol_spec.participant_ids if pid != self.client_id]
+        messages = await self.async_comm.retrieve_public_messages([(pid, label) for pid in peers])
+
+        values = list(shares)
+
+        for message in messages.values():
+            values = [v + r for v, r in zip(values, decode_shares(message))]
+
+        return values
+
+
+# label of the bundle of the secrets of a participant minus their masks
+MASKED_INPUTS_LABEL = "masked_inputs"
+
+
+def input_label(sender_id: str) -> str:
+    """Label of the bundle of shares of the secrets of a participant"""
+    return "input_shares_" + sender_id
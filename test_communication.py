@@ -0,0 +1,238 @@
+"""
+Tests of the communications between the clients and the server.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process
+
+import pytest
+import requests
+
+from communication import SESSION_HEADER, Communication, PeerCommunication, PushCommunication
+from secret_sharing import Share, ShareVector
+from serialization import decode_shares, encode_shares
+from server import run
+
+
+@pytest.fixture
+def server(request):
+    participants = getattr(request, "param", ["Alice", "Bob"] + [str(i) for i in range(20)])
+    server = Process(target=run, args=("localhost", 5000, participants))
+    server.start()
+    time.sleep(3)
+
+    yield
+
+    server.terminate()
+    server.join()
+    time.sleep(2)
+
+
+def test_batch_messages(server):
+    alice = Communication("localhost", 5000, "Alice")
+    bob = Communication("localhost", 5000, "Bob")
+
+    alice.publish_messages({"x": "1", "y/z": "2"})
+    bob.publish_message("x", "3")
+
+    messages = bob.retrieve_public_messages([("Alice", "x"), ("Alice", "y/z"), ("Bob", "x")])
+
+    assert messages == {("Alice", "x"): b"1", ("Alice", "y/z"): b"2", ("Bob", "x"): b"3"}
+
+
+def test_batch_messages_mixed_formats(server):
+    alice = Communication("localhost", 5000, "Alice")
+    bob = Communication("localhost", 5000, "Bob", binary=False)
+
+    shares = [Share(1), ShareVector([2, 2 ** 64 - 1])]
+    alice.publish_message("x", encode_shares(shares))
+
+    # a reader of JSON gets the binary message of a reader of the binary format
+    message = bob.retrieve_public_messages([("Alice", "x")])[("Alice", "x")]
+    assert message == encode_shares(shares)
+    assert [share.value for share in decode_shares(message)[:1]] == [1]
+    assert decode_shares(message)[1].values.tolist() == [2, 2 ** 64 - 1]
+
+
+def test_long_poll(server):
+    alice = Communication("localhost", 5000, "Alice")
+    bob = Communication("localhost", 5000, "Bob")
+
+    publisher = Process(target=lambda: time.sleep(1) or alice.publish_message("late", "4"))
+    publisher.start()
+
+    start = time.time()
+    message = bob.retrieve_public_message("Alice", "late")
+    publisher.join()
+
+    assert message == b"4"
+    # answered as soon as published, not after another polling delay
+    assert time.time() - start < 1 + bob.poll_delay
+
+
+def test_push_messages(server):
+    alice = Communication("localhost", 5000, "Alice")
+
+    # stored before Bob connects to the push transport
+    alice.publish_message("early", "1")
+
+    bob = PushCommunication("localhost", 5000, "Bob")
+
+    # sent over HTTP and over the push transport
+    alice.send_private_message("Bob", "x", "2")
+    bob.publish_messages({"y": "3", "z": "4"})
+
+    assert bob.retrieve_public_messages([("Alice", "early"), ("Bob", "y")]) == {
+        ("Alice", "early"): b"1", ("Bob", "y"): b"3"}
+    assert bob.retrieve_private_message("x") == b"2"
+    assert alice.retrieve_public_message("Bob", "z") == b"4"
+
+    bob.close()
+
+
+def test_concurrent_requests(server):
+    parties = [Communication("localhost", 5000, str(i)) for i in range(20)]
+
+    def exchange(i):
+        parties[i].publish_message(str(i), str(i))
+        return parties[i].retrieve_public_messages([(parties[j].client_id, str(j)) for j in range(len(parties))])
+
+    # every party publishes and waits for the others at the same time
+    with ThreadPoolExecutor(len(parties)) as executor:
+        results = list(executor.map(exchange, range(len(parties))))
+
+    expected = {(parties[j].client_id, str(j)): str(j).encode() for j in range(len(parties))}
+    assert all(result == expected for result in results)
+
+
+def test_peer_messages(server):
+    alice = PeerCommunication("localhost", 5000, "Alice", ["Alice", "Bob"])
+    bob = PeerCommunication("localhost", 5000, "Bob", ["Alice", "Bob"])
+
+    alice.send_private_message("Bob", "x", "1")
+    alice.publish_messages({"y": "2", "z/w": "3"})
+    bob.publish_message("y", "4")
+
+    assert bob.retrieve_private_message("x") == b"1"
+    assert bob.retrieve_public_messages([("Alice", "y"), ("Alice", "z/w"), ("Bob", "y")]) == {
+        ("Alice", "y"): b"2", ("Alice", "z/w"): b"3", ("Bob", "y"): b"4"}
+    assert alice.retrieve_public_message("Bob", "y") == b"4"
+
+    # only the addresses went through the server
+    assert alice.requests == 2 and bob.requests == 2
+
+    alice.close()
+    bob.close()
+
+
+def test_request_counters(server):
+    alice = Communication("localhost", 5000, "Alice", long_poll_timeout=None, poll_delay=0.01)
+
+    alice.publish_message("x", "1")
+    alice.retrieve_public_message("Alice", "x")
+    assert alice.unanswered_polls == 0
+
+    metrics = requests.get("http://localhost:5000/metrics").json()
+    counters = {(endpoint, status): count for endpoint, status, count in metrics["requests"]}
+
+    assert counters[("publish_message", 200)] == 1
+    assert counters[("retrieve_public_message", 200)] == 1
+    assert metrics["triplets"]["live_ops"] == 0
+
+
+@pytest.mark.parametrize("server", [["Alice", "Bob"]], indirect=True)
+def test_sessions(server):
+    alice = Communication("localhost", 5000, "Alice", session_id="1")
+    bob = Communication("localhost", 5000, "Bob", session_id="1")
+
+    alice.publish_message("x", "1")
+    alice.send_private_message("Bob", "y", "2")
+
+    # the messages of the first run are not seen from another one
+    other_run = requests.get("http://localhost:5000/public/Bob/Alice/x", headers={SESSION_HEADER: "2"})
+    assert other_run.status_code == 404
+
+    assert bob.retrieve_public_message("Alice", "x") == b"1"
+    assert bob.retrieve_private_message("y") == b"2"
+
+    # every message of the first run was read by the participants who should read it
+    metrics = requests.get("http://localhost:5000/metrics").json()
+    assert "1" not in metrics["messages"]
+
+
+@pytest.mark.parametrize("server", [["Alice", "Bob"]], indirect=True)
+def test_aggregated_opening(server):
+    alice = Communication("localhost", 5000, "Alice", session_id="1")
+    bob = PushCommunication("localhost", 5000, "Bob", session_id="1")
+
+    alice.contribute_opening("x", encode_shares([Share(2), ShareVector([1, 2])]))
+    bob.contribute_opening("x", encode_shares([Share(2 ** 64 - 1), ShareVector([3, 4])]))
+
+    for opened in [decode_shares(alice.retrieve_opening("x")), decode_shares(bob.retrieve_opening("x"))]:
+        assert opened[0].value == 1
+        assert opened[1].values.tolist() == [4, 6]
+
+    # the opened values are deleted once read by every participant
+    metrics = requests.get("http://localhost:5000/metrics").json()
+    assert "1" not in metrics["messages"]
+
+    bob.close()
+
+
+@pytest.mark.parametrize("server", [["Alice", "Bob"]], indirect=True)
+def test_refused_opening(server):
+    alice = Communication("localhost", 5000, "Alice")
+    eve = Communication("localhost", 5000, "Eve")
+
+    alice.contribute_opening("x", encode_shares([Share(1)]))
+
+    # twice from the same participant, with another number of shares, or not from a participant
+    for comm, shares in [(alice, [Share(1)]), (alice, [Share(1), Share(2)]), (eve, [Share(1)])]:
+        with pytest.raises(requests.HTTPError):
+            comm.contribute_opening("x", encode_shares(shares))
+
+
+@pytest.mark.parametrize("server", [["Alice", "Bob"]], indirect=True)
+def test_push_frames_restricted_to_messages(server):
+    alice = Communication("localhost", 5000, "Alice", session_id="1", long_poll_timeout=None)
+    bob = PushCommunication("localhost", 5000, "Bob", session_id="1")
+
+    # only the server writes the opened values
+    bob._send({("opened", "", "final"): encode_shares([Share(1234)]), ("hello", "Bob", "x"): b""})
+    bob.publish_message("y", "1")
+
+    assert alice.retrieve_public_message("Bob", "y") == b"1"
+    res = requests.get("http://localhost:5000/open/Alice/final", headers={SESSION_HEADER: "1"})
+    assert res.status_code == 404
+
+    # nothing is left in the session
+    assert "1" not in requests.get("http://localhost:5000/metrics").json()["messages"]
+
+    bob.close()
+
+
+def test_evicted_triplets_refused():
+    server = Process(target=run, args=("localhost", 5000, ["Alice", "Bob"], 2))
+    server.start()
+    time.sleep(3)
+
+    try:
+        alice = Communication("localhost", 5000, "Alice")
+        bob = Communication("localhost", 5000, "Bob")
+
+        for op_id in ["1", "2", "3"]:
+            alice.retrieve_beaver_triplet_shares(op_id)
+
+        # the triplet of "1" was evicted before Bob fetched it, a new one would not match Alice's
+        with pytest.raises(requests.HTTPError) as error:
+            bob.retrieve_beaver_triplet_shares("1")
+        assert error.value.response.status_code == 410
+        with pytest.raises(requests.HTTPError):
+            bob.retrieve_beaver_triplets_shares([("1", None), ("3", None)])
+
+        assert len(bob.retrieve_beaver_triplet_shares("3")) == 3
+    finally:
+        server.terminate()
+        server.join()
+        time.sleep(2)
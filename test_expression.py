@@ -5,7 +5,7 @@ Testing expressions is not obligatory.
 MODIFY THIS FILE.
 """
 
-from expression import Secret, Scalar
+from expression import Secret, Scalar, balance, fold_constants, multiplication_layers
 
 
 # Example test, you can adapt it to your needs.
@@ -46,3 +46,96 @@ def test4():
     c = Secret(2)
     expr = ((a * b + b * Scalar(4)) * c - (a + Scalar(1) * b))
     assert repr(expr) == "((Secret(3) * Secret(14) + Secret(14) * Scalar(4)) * Secret(2) - (Secret(3) + Scalar(1) * Secret(14)))"
+
+
+def test_multiplication_layers():
+    a = Secret(1)
+    b = Secret(2)
+    c = Secret(3)
+    d = Secret(4)
+    ab = a * b
+    cd = c * d
+    expr = ab * cd + a * Scalar(2) * c + Scalar(3) * Scalar(4)
+
+    layers = multiplication_layers(expr)
+
+    assert len(layers) == 2
+    assert [id(m) for m in layers[0]] == [id(ab), id(cd), id(expr.e1.e2)]
+    assert [id(m) for m in layers[1]] == [id(expr.e1.e1)]
+
+
+def test_balance():
+    secrets = [Secret(i) for i in range(1000)]
+
+    expr = secrets[0]
+    for s in secrets[1:]:
+        expr *= s
+    original_ids = set()
+    node = expr
+    while not isinstance(node, Secret):
+        original_ids.add(node.id)
+        node = node.e1
+
+    balanced = balance(expr)
+
+    assert len(multiplication_layers(balanced)) == 10
+    assert set(m.id for layer in multiplication_layers(balanced) for m in layer) == original_ids
+    assert balance(expr).id == balanced.id
+
+
+def test_balance_keeps_substractions_and_shared_nodes():
+    a = Secret(1)
+    b = Secret(2)
+    c = Secret(3)
+    shared = a + b
+    expr = (shared + c + a) * (shared - c)
+
+    balanced = balance(expr)
+
+    assert repr(balanced) == repr(expr)
+    assert balanced.id == expr.id
+    assert balanced.e2.id == expr.e2.id
+    assert balanced.e2.e1.id == shared.id
+
+
+def test_deep_expression():
+    a = Secret(1)
+    expr = a
+    for _ in range(100000):
+        expr = expr - Scalar(1)
+
+    assert repr(expr).startswith("(Secret(1) - Scalar(1) - Scalar(1)")
+    assert len(multiplication_layers(expr * a)) == 1
+
+
+def test_is_public():
+    a = Secret(1)
+    public = Scalar(3) * Scalar(4) - Scalar(2)
+    expr = public + a * Scalar(2)
+
+    assert public.is_public
+    assert not expr.is_public
+    assert not expr.e2.is_public
+    assert not balance(expr).is_public
+
+
+def test_fold_constants():
+    a = Secret(1)
+    public = Scalar(3) * (Scalar(2) + Scalar(1))
+    expr = public * a + (Scalar(2) - Scalar(5))
+
+    folded = fold_constants(expr)
+
+    assert repr(folded) == "(Scalar(9) * Secret(1) + Scalar(18446744073709551613))"
+    assert folded.e1.e1.id == public.id
+    assert folded.e1.e2 is a
+
+
+def test_fold_public_expression():
+    expr = Scalar(2 ** 63) * Scalar(2) + Scalar(3) * Scalar(4)
+
+    folded = fold_constants(expr)
+
+    assert isinstance(folded, Scalar)
+    assert folded.value == 12
+    assert folded.id == expr.id
@@ -0,0 +1,338 @@
+"""
+Integration tests for the optimizations of the protocol.
+"""
+
+import time
+from multiprocessing import Process, Queue
+
+import requests
+
+from expression import Scalar, Secret
+from protocol import ProtocolSpec
+from serialization import BINARY_CONTENT_TYPE
+from server import run
+from smc_party import SMCParty
+from test_integration import suite
+
+
+def smc_client(client_id, prot, value_dict, options, queue):
+    cli = SMCParty(
+        client_id,
+        "localhost",
+        5000,
+        protocol_spec=prot,
+        value_dict=value_dict,
+        **options
+    )
+    # the content types of the answers of the server, to check the format of the exchanges
+    content_types = set()
+    cli.comm.session.hooks["response"].append(
+        lambda res, *args, **kwargs: content_types.add(res.headers.get("Content-Type")))
+
+    result = cli.run()
+    queue.put((client_id, result, {"bytes_sent": cli.comm.bytes_sent, "content_types": content_types}))
+
+
+def suite_with_options(parties, expr, expected, **options):
+    """
+    Run the protocol like `suite`, with options given to every SMCParty.
+    Return the metrics of every client, and the counters of the requests answered by the server
+    indexed by (endpoint, status).
+    """
+    participants = list(parties.keys())
+    prot = ProtocolSpec(expr=expr, participant_ids=participants)
+
+    queue = Queue()
+    server = Process(target=run, args=("localhost", 5000, participants))
+    clients = [
+        Process(target=smc_client, args=(name, prot, value_dict, options, queue))
+        for name, value_dict in parties.items()
+    ]
+
+    server.start()
+    time.sleep(3)
+    for client in clients:
+        client.start()
+
+    for client in clients:
+        client.join()
+
+    results = [queue.get() for _ in clients]
+    metrics = requests.get("http://localhost:5000/metrics").json()
+
+    server.terminate()
+    server.join()
+    time.sleep(2)
+
+    for _, result, _ in results:
+        assert result == expected
+
+    counters = {(endpoint, status): count for endpoint, status, count in metrics["requests"]}
+    return {client_id: client_metrics for client_id, _, client_metrics in results}, counters
+
+
+def endpoint_requests(counters, endpoint):
+    """Number of requests answered by the server on an endpoint, whatever their status"""
+    return sum(count for (name, _), count in counters.items() if name == endpoint)
+
+
+def linear_circuit(bob_value):
+    """
+    f(a, b, c) = (a * b + c) * K between Alice, Bob and Charlie, Bob's secret being a vector.
+    Return the values of the parties, the expression and the expected result.
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: bob_value},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = (alice_secret * bob_secret + charlie_secret) * Scalar(5)
+    expected = [(3 * b + 2) * 5 for b in bob_value]
+    return parties, expr, expected
+
+
+def product_circuit():
+    """
+    f(a, b, c) = a * b * c + a * K between Alice, Bob and Charlie, with two rounds of multiplications.
+    Return the values of the parties, the expression and the expected result.
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: [14, 1]},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = alice_secret * bob_secret * charlie_secret + alice_secret * Scalar(5)
+    expected = [3 * 14 * 2 + 3 * 5, 3 * 1 * 2 + 3 * 5]
+    return parties, expr, expected
+
+
+MESSAGE_ENDPOINTS = [
+    "send_private_message",
+    "retrieve_private_message",
+    "publish_message",
+    "retrieve_public_message",
+    "publish_messages",
+    "retrieve_public_messages",
+]
+
+
+def test_deep_circuit():
+    """
+    f(a, b) = (a - 1 - 1 - ... - 1) * b
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 100003},
+        "Bob": {bob_secret: 2},
+    }
+
+    expr = alice_secret
+    for _ in range(100000):
+        expr = expr - Scalar(1)
+    expr = expr * bob_secret
+
+    expected = 3 * 2
+    suite(parties, expr, expected)
+
+
+def test_public_sub_expression_in_product():
+    """
+    f(a) = K0 * (K1 + K2) * a
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 4},
+    }
+
+    expr = Scalar(3) * (Scalar(2) + Scalar(1)) * alice_secret
+    expected = 3 * (2 + 1) * 3
+    suite(parties, expr, expected)
+
+
+def test_vector_secrets():
+    """
+    f(a, b, c) = a * b + K * c, element-wise
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+    charlie_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: [3, 4, 5]},
+        "Bob": {bob_secret: [14, 2, 2 ** 63]},
+        "Charlie": {charlie_secret: 2}
+    }
+
+    expr = alice_secret * bob_secret + Scalar([1, 2, 3]) * charlie_secret
+    expected = [3 * 14 + 1 * 2, 4 * 2 + 2 * 2, (5 * 2 ** 63 + 3 * 2) % 2 ** 64]
+    suite(parties, expr, expected)
+
+
+def test_json_format():
+    """
+    f(a, b, c) = (a * b + c) * K, with vectors, exchanging JSON instead of binary
+    """
+    parties, expr, expected = linear_circuit([14, 1])
+
+    clients, _ = suite_with_options(parties, expr, expected, binary=False)
+    for client_metrics in clients.values():
+        assert BINARY_CONTENT_TYPE not in client_metrics["content_types"]
+
+    # the binary format is the default
+    clients, _ = suite_with_options(parties, expr, expected)
+    for client_metrics in clients.values():
+        assert BINARY_CONTENT_TYPE in client_metrics["content_types"]
+
+
+def test_push_transport():
+    """
+    f(a, b, c) = (a * b + c) * K, the messages being pushed by the server
+    """
+    parties, expr, expected = linear_circuit([14, 1])
+
+    _, counters = suite_with_options(parties, expr, expected, push=True)
+
+    # no message goes through HTTP, only the Beaver triplets
+    for endpoint in MESSAGE_ENDPOINTS:
+        assert endpoint_requests(counters, endpoint) == 0
+    assert endpoint_requests(counters, "retrieve_shares") > 0
+
+
+def test_p2p_transport():
+    """
+    f(a, b, c) = (a * b + c) * K, the messages being sent directly between the parties
+    """
+    parties, expr, expected = linear_circuit([14, 1])
+
+    _, counters = suite_with_options(parties, expr, expected, p2p=True)
+
+    # the server only sees the address of every party
+    assert counters[("publish_message", 200)] == len(parties)
+    for endpoint in ["send_private_message", "retrieve_private_message", "publish_messages"]:
+        assert endpoint_requests(counters, endpoint) == 0
+
+
+def test_prg_sharing():
+    """
+    f(a, b, c) = (a * b + c) * K, with vectors, the shares of the inputs being derived from seeds
+    """
+    bob_value = list(range(1000))
+    parties, expr, expected = linear_circuit(bob_value)
+    prot = ProtocolSpec(expr=expr, participant_ids=list(parties))
+
+    # the input phase sends a seed to each other party instead of the shares of the 1000 values
+    input_bytes = dict()
+    for prg_sharing in [True, False]:
+        bob = SMCParty("Bob", "localhost", 5000, prot, parties["Bob"], prg_sharing=prg_sharing)
+        input_bytes[prg_sharing] = sum(len(bundle) for bundle in bob.share_inputs().values())
+        bob.async_comm.close()
+    assert input_bytes[True] < 200
+    assert input_bytes[False] > 2 * 8 * len(bob_value)
+
+    clients, _ = suite_with_options(parties, expr, expected, prg_sharing=True)
+    plain_clients, _ = suite_with_options(parties, expr, expected)
+    assert clients["Bob"]["bytes_sent"] < plain_clients["Bob"]["bytes_sent"] - 8 * len(bob_value)
+
+
+def test_prg_triplets():
+    """
+    f(a, b, c) = a * b * c + a * K, with vectors, the Beaver triplets being derived from seeds
+    """
+    parties, expr, expected = product_circuit()
+
+    _, counters = suite_with_options(parties, expr, expected, prg_triplets=True)
+
+    # a seed per party, and no share of triplet requested
+    assert counters[("retrieve_seed", 200)] == len(parties)
+    assert endpoint_requests(counters, "retrieve_share") == 0
+    assert endpoint_requests(counters, "retrieve_shares") == 0
+
+
+def test_input_masks():
+    """
+    f(a, b, c) = (a * b + c) * K, with vectors, the secrets being published minus masks dealt by the server
+    """
+    parties, expr, expected = linear_circuit([14, 1])
+
+    _, counters = suite_with_options(parties, expr, expected, input_masks=True, prg_triplets=True)
+
+    # the inputs are published, no share is sent privately
+    assert counters[("retrieve_masks", 200)] == len(parties)
+    assert endpoint_requests(counters, "send_private_message") == 0
+    assert endpoint_requests(counters, "retrieve_private_message") == 0
+
+
+def test_aggregated_openings():
+    """
+    f(a, b, c) = a * b * c + a * K, with vectors, the values being opened by the server
+    """
+    parties, expr, expected = product_circuit()
+
+    # every party sends its shares and reads the opened values once per opening, O(n) requests
+    _, counters = suite_with_options(parties, expr, expected, aggregate_openings=True)
+    openings = counters[("contribute_opening", 200)] // len(parties)
+    assert openings > 0
+    assert counters[("contribute_opening", 200)] == len(parties) * openings
+    assert counters[("retrieve_opening", 200)] == len(parties) * openings
+    assert endpoint_requests(counters, "retrieve_public_messages") == 0
+
+    # the opened values are pushed
+    _, counters = suite_with_options(parties, expr, expected, aggregate_openings=True, push=True)
+    assert counters[("contribute_opening", 200)] == len(parties) * openings
+    assert endpoint_requests(counters, "retrieve_opening") == 0
+
+
+def test_back_to_back_runs():
+    """
+    f(a, b) = a * b + K computed twice on the same server, each run in its own session
+    """
+    alice_secret = Secret()
+    bob_secret = Secret()
+
+    parties = {
+        "Alice": {alice_secret: 3},
+        "Bob": {bob_secret: 14}
+    }
+    expr = alice_secret * bob_secret + Scalar(5)
+
+    server = Process(target=run, args=("localhost", 5000, list(parties)))
+    server.start()
+    time.sleep(3)
+
+    try:
+        for _ in range(2):
+            prot = ProtocolSpec(expr=expr, participant_ids=list(parties))
+
+            queue = Queue()
+            clients = [
+                Process(target=smc_client, args=(name, prot, value_dict, {}, queue))
+                for name, value_dict in parties.items()
+            ]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+
+            assert [queue.get()[1] for _ in clients] == [3 * 14 + 5] * 2
+
+        # every message was deleted once read
+        assert requests.get("http://localhost:5000/metrics").json()["messages"] == {}
+    finally:
+        server.terminate()
+        server.join()
+        time.sleep(2)
@@ -5,7 +5,17 @@ Testing secret sharing is not obligatory.
 MODIFY THIS FILE.
 """
 
-from secret_sharing import share_secret, reconstruct_secret
+from secret_sharing import (
+    Share,
+    ShareVector,
+    new_seed,
+    prg_share,
+    reconstruct_secret,
+    reconstruct_secrets,
+    share_secret,
+    share_secret_with_seeds,
+    share_secrets,
+)
 
 
 def test():
@@ -34,3 +44,45 @@ def test():
     recovered_value = reconstruct_secret(shares)
 
     assert recovered_value == test_value
+
+
+def test_vectors():
+
+    secrets = [0, 15, 2 ** 64 - 1, 123456789123456789]
+
+    for nbr_participants in [1, 2, 10]:
+
+        shares = share_secrets(secrets, nbr_participants)
+
+        assert len(shares) == nbr_participants
+        assert reconstruct_secrets(shares).tolist() == secrets
+
+
+def test_vector_arithmetic():
+
+    x = ShareVector([2 ** 64 - 1, 3])
+    y = ShareVector([2, 2 ** 63])
+
+    assert (x + y).values.tolist() == [1, 2 ** 63 + 3]
+    assert (x - y).values.tolist() == [2 ** 64 - 3, 2 ** 63 + 3]
+    assert (x * y).values.tolist() == [2 ** 64 - 2, 2 ** 63]
+    assert (Share(2) * x).values.tolist() == [2 ** 64 - 2, 6]
+    assert (Share(1) - x).values.tolist() == [2, 2 ** 64 - 2]
+    assert (x + Share(2 ** 64 + 1)).values.tolist() == [0, 4]
+
+
+def test_seeded_shares():
+
+    seeds = [new_seed() for _ in range(3)]
+
+    dealer_share = share_secret_with_seeds(42, seeds, "1")
+    assert reconstruct_secret([dealer_share] + [prg_share(seed, "1") for seed in seeds]) == 42
+
+    secrets = [0, 2 ** 64 - 1, 7]
+    dealer_shares = share_secret_with_seeds(secrets, seeds, "2")
+    shares = [dealer_shares] + [prg_share(seed, "2", len(secrets)) for seed in seeds]
+    assert reconstruct_secrets(shares).tolist() == secrets
+
+    # derived again by the holders of the seeds, different for every label
+    assert prg_share(seeds[0], "1").value == prg_share(seeds[0], "1").value
+    assert prg_share(seeds[0], "1").value != prg_share(seeds[0], "3").value
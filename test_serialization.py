@@ -0,0 +1,72 @@
+"""
+Unit tests for the encoding of shares and messages.
+"""
+
+from secret_sharing import Share, ShareVector, new_seed, prg_share
+from serialization import (
+    decode_share_bundle,
+    decode_shares,
+    encode_seed_bundle,
+    encode_share_bundle,
+    encode_shares,
+    pack_messages,
+    unpack_messages,
+)
+
+
+def test_shares():
+
+    shares = [Share(3), ShareVector([1, 2 ** 64 - 1, 0]), Share(2 ** 64 - 1), ShareVector([])]
+
+    for binary in [True, False]:
+        decoded = decode_shares(encode_shares(shares, binary))
+
+        assert [type(share) for share in decoded] == [type(share) for share in shares]
+        assert decoded[0].value == 3
+        assert decoded[1].values.tolist() == [1, 2 ** 64 - 1, 0]
+        assert decoded[2].value == 2 ** 64 - 1
+        assert len(decoded[3]) == 0
+
+    assert decode_shares(encode_shares([])) == []
+
+
+def test_binary_is_compact():
+
+    shares = [ShareVector(list(range(2 ** 63, 2 ** 63 + 1000)))]
+
+    assert len(encode_shares(shares)) == 1 + 4 + 4 + 8 * 1000
+    assert len(encode_shares(shares, binary=False)) > 20 * 1000
+
+
+def test_share_bundle():
+
+    shares = {"1": Share(3), "2": ShareVector([1, 2 ** 64 - 1])}
+
+    for binary in [True, False]:
+        decoded = decode_share_bundle(encode_share_bundle(shares, binary))
+
+        assert decoded["1"].value == 3
+        assert decoded["2"].values.tolist() == [1, 2 ** 64 - 1]
+        assert decode_share_bundle(encode_share_bundle({}, binary)) == {}
+
+
+def test_seed_bundle():
+
+    seed = new_seed()
+    sizes = {"1": None, "2": 10000}
+
+    for binary in [True, False]:
+        encoded = encode_seed_bundle(seed, sizes, binary)
+        decoded = decode_share_bundle(encoded)
+
+        assert decoded["1"].value == prg_share(seed, "1").value
+        assert decoded["2"].values.tolist() == prg_share(seed, "2", 10000).values.tolist()
+        # the shares are not sent
+        assert len(encoded) < 100
+
+
+def test_messages():
+
+    messages = {("Alice", "x_minus_a"): b"\x00\x01", ("Bob", "été"): b"", ("", "final"): b"42"}
+
+    assert unpack_messages(pack_messages(messages), 2) == messages
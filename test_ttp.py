@@ -5,10 +5,15 @@ Testing ttp is not obligatory.
 MODIFY THIS FILE.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
 from ttp import *
 from secret_sharing import *
 
-from ttp import TrustedParamGenerator
+from secret_sharing import seeded_mask, seeded_triplet
+from ttp import TrustedParamGenerator, gen_triplets_shares, sum_shares
 
 
 def test():
@@ -30,3 +35,165 @@ def test():
     c = reconstruct_secret(list({alice_shares[2], bob_shares[2], charlie_shares[2]}))
 
     assert mul_mod(a, b) == c
+
+
+def test_vector_triplets():
+
+    ttp = TrustedParamGenerator()
+
+    ttp.add_participant("Alice")
+    ttp.add_participant("Bob")
+
+    alice_shares = ttp.retrieve_share("Alice", "1", 5)
+    bob_shares = ttp.retrieve_share("Bob", "1", 5)
+
+    a = reconstruct_secrets([alice_shares[0], bob_shares[0]])
+    b = reconstruct_secrets([alice_shares[1], bob_shares[1]])
+    c = reconstruct_secrets([alice_shares[2], bob_shares[2]])
+
+    assert len(c) == 5
+    assert (a * b).tolist() == c.tolist()
+
+
+def test_retrieve_many_triplets():
+
+    ttp = TrustedParamGenerator()
+
+    ttp.add_participant("Alice")
+    ttp.add_participant("Bob")
+
+    ops = [("1", None), ("2", 3)]
+
+    alice_triplets = ttp.retrieve_shares("Alice", ops)
+    bob_triplets = ttp.retrieve_shares("Bob", ops)
+
+    assert len(alice_triplets[1][0]) == 3
+
+    a = reconstruct_secret([alice_triplets[0][0], bob_triplets[0][0]])
+    b = reconstruct_secret([alice_triplets[0][1], bob_triplets[0][1]])
+    c = reconstruct_secret([alice_triplets[0][2], bob_triplets[0][2]])
+
+    assert mul_mod(a, b) == c
+
+
+def test_batch_generation():
+
+    nbr_participants = 5
+    nbr_triplets = 1000
+
+    shares = gen_triplets_shares(nbr_participants, nbr_triplets)
+    assert shares.shape == (3, nbr_participants, nbr_triplets)
+
+    a, b, c = (shares[i].sum(axis=0, dtype=np.uint64) for i in range(3))
+    assert (a * b == c).all()
+
+
+def test_triplets_freed_once_fetched():
+
+    ttp = TrustedParamGenerator()
+
+    ttp.add_participant("Alice")
+    ttp.add_participant("Bob")
+
+    ttp.retrieve_shares("Alice", [("1", None), ("2", 10)])
+    ttp.retrieve_share("Bob", "1")
+
+    assert ttp.metrics()["live_ops"] == 1
+    assert ttp.metrics()["live_bytes"] == 3 * 2 * 11 * 8
+
+    ttp.retrieve_share("Bob", "2", 10)
+
+    assert ttp.metrics()["live_ops"] == 0
+    assert ttp.metrics()["live_bytes"] == 0
+    assert ttp.metrics()["freed_ops"] == 2
+
+
+def test_triplets_cap():
+
+    ttp = TrustedParamGenerator(max_ops=10)
+
+    ttp.add_participant("Alice")
+    ttp.add_participant("Bob")
+
+    for op_id in range(25):
+        ttp.retrieve_share("Alice", str(op_id))
+
+    assert ttp.metrics()["live_ops"] == 10
+    assert ttp.metrics()["evicted_ops"] == 15
+    assert "24" in ttp.triplets_shares and "14" not in ttp.triplets_shares
+
+    # Bob cannot get a new triplet for an operation Alice already fetched
+    assert ttp.retrieve_share("Bob", "14") is None
+    assert ttp.retrieve_shares("Bob", [("14", None), ("24", None)]) is None
+    assert "14" not in ttp.triplets_shares
+    assert ttp.retrieve_share("Bob", "24") is not None
+
+    # the operations of a batch larger than the cap are kept until fetched
+    assert len(ttp.retrieve_shares("Alice", [(str(op_id), None) for op_id in range(30, 50)])) == 20
+    assert len(ttp.retrieve_shares("Bob", [("24", None), ("49", None)])) == 2
+
+
+def test_concurrent_retrievals():
+
+    nbr_participants = 10
+    ops = [(str(op_id), None) for op_id in range(50)]
+
+    ttp = TrustedParamGenerator()
+    for i in range(nbr_participants):
+        ttp.add_participant(str(i))
+
+    # every participant asks for the same operations at the same time
+    with ThreadPoolExecutor(nbr_participants) as executor:
+        triplets = list(executor.map(lambda i: ttp.retrieve_shares(str(i), ops), range(nbr_participants)))
+
+    for op in range(len(ops)):
+        a, b, c = (reconstruct_secret([triplets[i][op][j] for i in range(nbr_participants)]) for j in range(3))
+        assert mul_mod(a, b) == c
+
+    assert ttp.metrics()["generated_ops"] == len(ops)
+    assert ttp.metrics()["freed_ops"] == len(ops)
+
+
+def test_seeded_triplets():
+
+    ttp = TrustedParamGenerator()
+
+    for participant in ["Alice", "Bob", "Charlie"]:
+        ttp.add_participant(participant)
+
+    ops = [("1", None), ("2", 3)]
+
+    seeds = {participant: ttp.retrieve_seed(participant, "session") for participant in ttp.participant_ids}
+    assert [pid for pid, (_, designated) in seeds.items() if designated] == ["Charlie"]
+    assert ttp.retrieve_corrections("Alice", "session", ops) is None
+
+    corrections = ttp.retrieve_corrections("Charlie", "session", ops)
+
+    for (op_id, size), correction in zip(ops, corrections):
+        triplets = {pid: seeded_triplet(seed, op_id, size) for pid, (seed, _) in seeds.items()}
+        triplets["Charlie"] = triplets["Charlie"][:2] + (correction,)
+
+        a, b, c = (sum_shares([triplet[i] for triplet in triplets.values()]) for i in range(3))
+        assert share_value(a * b) == share_value(c)
+
+    # forgotten once every participant got what it needs
+    assert ttp.seeds == {}
+
+
+def test_input_masks():
+
+    ttp = TrustedParamGenerator()
+
+    for participant in ["Alice", "Bob"]:
+        ttp.add_participant(participant)
+
+    masks = ttp.retrieve_masks("Alice", "session", [("1", None), ("2", 2)])
+    seeds = [ttp.retrieve_seed(participant, "session")[0] for participant in ["Alice", "Bob"]]
+
+    assert masks[0].value == reconstruct_secret([seeded_mask(seed, "Alice", "1") for seed in seeds])
+    assert masks[1].values.tolist() == reconstruct_secrets(
+        [seeded_mask(seed, "Alice", "2", 2) for seed in seeds]).tolist()
+
+    # the masks are bound to their owner: asking for the secret of Alice, Bob does not learn its mask
+    assert ttp.retrieve_masks("Bob", "session", [("1", None)])[0].value != masks[0].value
+    assert ttp.retrieve_masks("Charlie", "session", [("1", None)]) is None
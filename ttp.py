@@ -5,80 +5,382 @@ MODIFY THIS FILE.
 """
 
 import collections
-import random
 import sys
+import threading
 from secret_sharing import *
+
+import numpy as np
 from typing import (
     Dict,
+    List,
+    Optional,
     Set,
     Tuple,
+    Union,
 )
 
 from communication import Communication
 from secret_sharing import (
-    share_secret,
+    new_seed,
+    random_uint64,
+    seeded_mask,
+    seeded_triplet,
     Share,
+    ShareVector,
 )
 
 
 # Feel free to add as many imports as you want.
 
 
+# number of sessions whose seeds are kept, the oldest being forgotten first
+MAX_SEED_SESSIONS = 1000
+
+
+class TripletStore:
+    """
+    Storage of the Beaver triplets shares that are not yet fetched by every participant.
+
+    The shares of a batch of triplets live in a single uint64 array of shape
+    (3, number of participants, number of triplets), and every operation keeps the position of its
+    triplets in its batch along with the set of participants who fetched them, as a bitmask.
+    An operation is dropped once every participant fetched its shares, and a batch is freed with
+    its last operation.
+
+    If `max_ops` is given, the oldest operations are evicted when more operations are stored.
+    The ids of the last `max_ops` evicted operations are kept, so that a participant fetching one
+    of them is refused instead of getting a new triplet, inconsistent with the shares the others
+    already hold. The cap must be above the number of multiplications in flight. The operations of
+    the last batch are never evicted, so that they can be fetched, even if they exceed the cap.
+    """
+
+    def __init__(self, num_participants: int, max_ops: Optional[int] = None):
+        self.num_participants = num_participants
+        self.max_ops = max_ops
+
+        # op_id -> [shares of the batch, offset in the batch, size or None, bitmask of fetches]
+        self.entries: Dict[str, list] = dict()
+        # ids of the last evicted operations, the oldest first
+        self.evicted: Dict[str, None] = dict()
+
+        # Record metrics
+        self.generated_ops = 0
+        self.freed_ops = 0
+        self.evicted_ops = 0
+
+    def __contains__(self, op_id: str) -> bool:
+        return op_id in self.entries
+
+    def was_evicted(self, op_id: str) -> bool:
+        """Tell if the triplets of an operation were evicted before every participant fetched them"""
+        return op_id in self.evicted
+
+    def add_batch(self, ops: List[Tuple[str, Optional[int]]], batch: np.ndarray) -> None:
+        """Store a batch of triplets shares, the triplets of the operations following each other"""
+
+        offset = 0
+        for op_id, size in ops:
+            self.entries[op_id] = [batch, offset, size, 0]
+            offset += 1 if size is None else size
+
+        self.generated_ops += len(ops)
+
+        if self.max_ops is not None:
+            batch_ops = set(op_id for op_id, _ in ops)
+            while len(self.entries) > self.max_ops and next(iter(self.entries)) not in batch_ops:
+                op_id = next(iter(self.entries))
+                del self.entries[op_id]
+                self.evicted[op_id] = None
+                self.evicted_ops += 1
+
+            while len(self.evicted) > self.max_ops:
+                del self.evicted[next(iter(self.evicted))]
+
+    def fetch(self, op_id: str, participant: int) -> Tuple[np.ndarray, Optional[int]]:
+        """
+        Return the (3, size) shares of a participant for an operation, and the size of the operation.
+        The operation is freed once every participant fetched it.
+        """
+
+        entry = self.entries[op_id]
+        batch, offset, size, fetched = entry
+
+        shares = batch[:, participant, offset:offset + (1 if size is None else size)]
+
+        entry[3] = fetched | (1 << participant)
+        if entry[3] == (1 << self.num_participants) - 1:
+            del self.entries[op_id]
+            self.freed_ops += 1
+
+        return shares, size
+
+    def metrics(self) -> Dict[str, int]:
+        """Return the number of live operations and bytes, and counters of the operations lifecycle"""
+
+        batches = {id(entry[0]): entry[0] for entry in self.entries.values()}
+
+        return {
+            "live_ops": len(self.entries),
+            "live_bytes": sum(batch.nbytes for batch in batches.values()),
+            "generated_ops": self.generated_ops,
+            "freed_ops": self.freed_ops,
+            "evicted_ops": self.evicted_ops,
+        }
+
+
 class TrustedParamGenerator:
     """
     A trusted third party that generates random values for the Beaver triplet multiplication scheme.
+
+    Triplets are generated in batches and kept in a TripletStore until every participant fetched
+    them. `max_ops` caps the number of operations stored, see TripletStore.
+    The methods can be called from concurrent threads: the triplets of an operation are generated
+    once, whoever asks for them first.
     """
 
-    def __init__(self):
+    def __init__(self, max_ops: Optional[int] = None):
         self.participant_ids: Set[str] = set()
-        self.triplets_shares: Dict[str, Dict[str, Tuple[Share, Share, Share]]] = dict()
+        # position of each participant in the arrays of shares
+        self.participant_index: Dict[str, int] = dict()
+        self.max_ops = max_ops
+        self.triplets_shares = TripletStore(0, max_ops)
+        self.lock = threading.Lock()
+
+        # session id -> participant id -> seed of its triplets and input masks, see `retrieve_seed`
+        self.seeds: Dict[str, Dict[str, bytes]] = dict()
+        # session id -> participants who fetched their seed, and whether the corrections were computed
+        self.seed_fetches: Dict[str, Set[str]] = collections.defaultdict(set)
+        self.corrections_done: Set[str] = set()
 
     def add_participant(self, participant_id: str) -> None:
         """
         Add a participant.
         """
-        self.participant_ids.add(participant_id)
+        with self.lock:
+            if participant_id not in self.participant_ids:
+                self.participant_index[participant_id] = len(self.participant_index)
+                # the triplets must be shared between every participant
+                self.triplets_shares = TripletStore(len(self.participant_index), self.max_ops)
+            self.participant_ids.add(participant_id)
 
-    def retrieve_share(self, client_id: str, op_id: str) -> Tuple[Share, Share, Share]:
+    def retrieve_share(
+            self,
+            client_id: str,
+            op_id: str,
+            size: Optional[int] = None
+    ) -> Tuple[Union[Share, ShareVector], ...]:
         """
         Retrieve a triplet of shares for a given client_id. And operation id.
+        If a size is given, the triplet is a vector of `size` independent triplets.
+        Return None if the triplets of the operation were evicted, see `TripletStore`.
+        """
+        if client_id not in self.participant_ids:
+            return None
+
+        with self.lock:
+            if self.triplets_shares.was_evicted(op_id):
+                return None
+
+            # generate the triplets of this operation if not already done
+            if op_id not in self.triplets_shares:
+                self.gen_beaver(op_id, size)
+
+            return self._client_triplet(client_id, op_id)
+
+    def retrieve_shares(
+            self,
+            client_id: str,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> List[Tuple[Union[Share, ShareVector], ...]]:
+        """
+        Retrieve the triplets of shares of a given client_id for many operations at once.
+        `ops` lists the (operation id, size) pairs, see `retrieve_share`.
+        Return None if the triplets of any of the operations were evicted, see `TripletStore`.
         """
         if client_id not in self.participant_ids:
             return None
 
-        # first check if dict not already generated
-        if op_id in self.triplets_shares.keys():
-            return self.triplets_shares[op_id][client_id]
+        with self.lock:
+            if any(self.triplets_shares.was_evicted(op_id) for op_id, _ in ops):
+                return None
+
+            # an operation listed twice is only fetched once
+            # the stored triplets are fetched before generating the others, which may evict them
+            triplets = {
+                op_id: self._client_triplet(client_id, op_id)
+                for op_id in dict(ops) if op_id in self.triplets_shares
+            }
+
+            # generate all the missing triplets in a single batch
+            missing = [(op_id, size) for op_id, size in dict(ops).items() if op_id not in triplets]
+            if missing:
+                self.gen_beaver_batch(missing)
+                triplets.update((op_id, self._client_triplet(client_id, op_id)) for op_id, _ in missing)
+
+        return [triplets[op_id] for op_id, _ in ops]
 
-        else:
-            # generate the dict corresponding to this new operation and return result
-            self.gen_beaver(op_id)
-            return self.triplets_shares[op_id][client_id]
+    def designated_participant(self) -> str:
+        """
+        The participant who receives the corrections of the triplets derived from seeds.
+        """
+        return max(self.participant_index, key=self.participant_index.get)
 
-    def gen_beaver(self, op_id):
-        """Generates a new dictionary containing all beaver triplets for each client for a specific operation
-        indexed by op_id """
+    def retrieve_seed(self, client_id: str, session_id: str) -> Optional[Tuple[bytes, bool]]:
+        """
+        Retrieve the seed of a client for the triplets of a session, and whether it is the designated
+        participant who must fetch the corrections of the c shares with `retrieve_corrections`.
 
-        a = random.randint(0, get_mod())
-        b = random.randint(0, get_mod())
+        The shares of the triplet of an operation are derived by `seeded_triplet`, except for the
+        c share of the designated participant, and the shares of the mask of a secret by `seeded_mask`.
+        """
+        if client_id not in self.participant_ids:
+            return None
 
-        c = mul_mod(a, b)
+        with self.lock:
+            seed = self._session_seeds(session_id)[client_id]
+            self.seed_fetches[session_id].add(client_id)
+            self._free_seeds(session_id)
 
-        # generate shares of beaver triplets
-        a_shares = share_secret(a, len(self.participant_ids))
-        b_shares = share_secret(b, len(self.participant_ids))
-        c_shares = share_secret(c, len(self.participant_ids))
+        return seed, client_id == self.designated_participant()
+
+    def retrieve_corrections(
+            self,
+            client_id: str,
+            session_id: str,
+            ops: List[Tuple[str, Optional[int]]]
+    ) -> Optional[List[Union[Share, ShareVector]]]:
+        """
+        Retrieve the c shares of the designated participant for the triplets of a session derived
+        from seeds, making the c shares of every participant sum to a * b.
+        `ops` lists the (operation id, size) pairs, see `retrieve_share`.
+        """
+        if client_id != self.designated_participant():
+            return None
+
+        with self.lock:
+            seeds = self._session_seeds(session_id)
+            self.corrections_done.add(session_id)
+
+        corrections = []
+        for op_id, size in ops:
+            triplets = [seeded_triplet(seed, op_id, size) for seed in seeds.values()]
+
+            a = sum_shares([triplet[0] for triplet in triplets])
+            b = sum_shares([triplet[1] for triplet in triplets])
+            others_c = sum_shares([triplet[2] for pid, triplet in zip(seeds, triplets) if pid != client_id])
+
+            corrections.append(a * b - others_c)
+
+        with self.lock:
+            self._free_seeds(session_id)
+
+        return corrections
+
+    def retrieve_masks(
+            self,
+            client_id: str,
+            session_id: str,
+            secrets: List[Tuple[str, Optional[int]]]
+    ) -> Optional[List[Union[Share, ShareVector]]]:
+        """
+        Retrieve the masks of the secrets of a client, whose shares every participant derives from
+        its seed with `seeded_mask`. The client publishes its secrets minus their masks.
+        `secrets` lists the (secret id, size) pairs, size being None for single values.
+        The masks are derived from the id of the client, so that a client only ever learns the masks
+        of its own secrets: asking for the secret of another participant gives an unrelated mask.
+        """
+        if client_id not in self.participant_ids:
+            return None
+
+        with self.lock:
+            seeds = self._session_seeds(session_id)
+
+        return [
+            sum_shares([seeded_mask(seed, client_id, secret_id, size) for seed in seeds.values()])
+            for secret_id, size in secrets
+        ]
+
+    def _session_seeds(self, session_id: str) -> Dict[str, bytes]:
+        """Return the seeds of every participant for a session, drawing them the first time"""
+
+        if session_id not in self.seeds:
+            self.seeds[session_id] = {pid: new_seed() for pid in self.participant_index}
+
+            # sessions without multiplications never get their corrections
+            while len(self.seeds) > MAX_SEED_SESSIONS:
+                self._forget_seeds(next(iter(self.seeds)))
+
+        return self.seeds[session_id]
+
+    def _free_seeds(self, session_id: str) -> None:
+        """Forget the seeds of a session once every participant fetched its seed and the corrections"""
+
+        if session_id in self.corrections_done and self.seed_fetches[session_id] >= self.participant_ids:
+            self._forget_seeds(session_id)
+
+    def _forget_seeds(self, session_id: str) -> None:
+        """Forget the seeds of a session"""
+
+        del self.seeds[session_id]
+        self.seed_fetches.pop(session_id, None)
+        self.corrections_done.discard(session_id)
+
+    def gen_beaver(self, op_id, size=None):
+        """Generates the beaver triplets shares of each client for a specific operation indexed by op_id.
+        The triplets are ShareVectors of `size` elements if a size is given."""
+
+        self.gen_beaver_batch([(op_id, size)])
+
+    def gen_beaver_batch(self, ops: List[Tuple[str, Optional[int]]]) -> None:
+        """Generates the beaver triplets shares of each client for many operations at once"""
+
+        count = sum(1 if size is None else size for _, size in ops)
+
+        self.triplets_shares.add_batch(ops, gen_triplets_shares(len(self.participant_index), count))
+
+    def _client_triplet(self, client_id: str, op_id: str) -> Tuple[Union[Share, ShareVector], ...]:
+        """Return the shares of the triplets of an operation for a client"""
+
+        shares, size = self.triplets_shares.fetch(op_id, self.participant_index[client_id])
+
+        if size is None:
+            return tuple(Share(int(values[0])) for values in shares)
+
+        return tuple(ShareVector(values) for values in shares)
+
+    def metrics(self) -> Dict[str, int]:
+        """Return the metrics of the stored triplets"""
+
+        with self.lock:
+            return self.triplets_shares.metrics()
+
+
+def sum_shares(shares: List[Union[Share, ShareVector]]) -> Union[Share, ShareVector]:
+    """
+    Sum shares, e.g. the shares of every participant to reconstruct a value.
+    """
+
+    total = Share(0)
+    for share in shares:
+        total = total + share
+
+    return total
+
+
+def gen_triplets_shares(num_participants: int, count: int) -> np.ndarray:
+    """
+    Generate `count` Beaver triplets shared between `num_participants` participants.
+
+    Returns an array of shape (3, num_participants, count) holding the shares of a, b and c.
+    """
 
-        # store shares in a dict
-        res = dict()
+    a = random_uint64(count)
+    b = random_uint64(count)
 
-        for i, name in enumerate(self.participant_ids):
-            l = list()
-            l.append(a_shares[i])
-            l.append(b_shares[i])
-            l.append(c_shares[i])
+    shares = random_uint64((3, num_participants, count))
 
-            res[name] = tuple(l)
+    # the last participant gets the correction making every share sum to a, b and a * b
+    for i, value in enumerate((a, b, a * b)):
+        shares[i, -1] = value - shares[i, :-1].sum(axis=0, dtype=np.uint64)
 
-        # index dict w.r.t the operation id
-        self.triplets_shares[op_id] = res
+    return shares